@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+from rasterio import transform
+
+from urban_es_proposal import make_candidate_pixels
+
+suhi = pytest.importorskip('swiss_uhi_utils')
+
+
+@pytest.fixture
+def lulc_inputs(tmp_path):
+    # random LULC raster (with some nodata) and biophysical table
+    rng = np.random.default_rng(0)
+    biophysical_table_filepath = tmp_path / 'biophysical-table.csv'
+    pd.DataFrame({
+        'lucode': range(12),
+        'Shade': np.round(rng.uniform(0, 1, 12), 2),
+        'Kc': 1,
+        'Albedo': 0.2,
+        'Green_area': 0,
+        'Building_intensity': 0,
+    }).to_csv(biophysical_table_filepath, index=False)
+    lulc_arr = rng.integers(0, 12, (50, 60)).astype('uint8')
+    lulc_arr[:5, :5] = 255
+    lulc_filepath = tmp_path / 'lulc.tif'
+    with rio.open(lulc_filepath,
+                  'w',
+                  driver='GTiff',
+                  width=60,
+                  height=50,
+                  count=1,
+                  dtype='uint8',
+                  nodata=255,
+                  crs='epsg:2056',
+                  transform=transform.from_origin(2538000, 1152000, 10,
+                                                  10)) as dst:
+        dst.write(lulc_arr, 1)
+    return str(lulc_filepath), str(biophysical_table_filepath), lulc_arr
+
+
+@pytest.mark.parametrize('shade_threshold', [0.25, 0.5, 0.75, 1])
+def test_min_threshold_matches_scenario_generator(lulc_inputs,
+                                                  shade_threshold):
+    # the vectorized candidate rule selects the same pixels as swiss_uhi_utils
+    lulc_filepath, biophysical_table_filepath, lulc_arr = lulc_inputs
+    min_threshold_arr = make_candidate_pixels.get_min_threshold_arr(
+        lulc_arr,
+        make_candidate_pixels.get_shade_lut_arr(
+            biophysical_table_filepath, make_candidate_pixels.ORIG_LULC_CODES))
+    sg = suhi.ScenarioGenerator(
+        lulc_filepath,
+        biophysical_table_filepath,
+        orig_lulc_codes=make_candidate_pixels.ORIG_LULC_CODES)
+    assert np.array_equal(
+        np.flatnonzero(min_threshold_arr < shade_threshold),
+        np.sort(sg.get_candidate_pixels_df(shade_threshold, 1).index))
@@ -0,0 +1,52 @@
+from os import path
+
+import geopandas as gpd
+
+# lulc column in Vaud's cadastre shapefile
+CADASTRE_LULC_COLUMN = 'GENRE'
+
+# number of features of each GeoParquet row group, whose bounding boxes allow
+# skipping the row groups outside a bbox when reading
+ROW_GROUP_SIZE = 10000
+
+
+def dump_cadastre(cadastre_gdf,
+                  dst_filepath,
+                  columns=None,
+                  row_group_size=ROW_GROUP_SIZE):
+    # dump the cadastre (only the LULC column and the geometry by default) in
+    # a format based on the extension of `dst_filepath`. The order of the
+    # features is kept since it sets their priority when rasterizing (and the
+    # features of each layer are already spatially grouped by commune):
+    # * GeoParquet (".parquet"), partitioned into row groups with their
+    #   bounding box (covering) column
+    # * GeoPackage (".gpkg"), with an R-tree spatial index
+    # * any other format supported by `to_file`, e.g., a shapefile
+    if columns is None:
+        columns = [CADASTRE_LULC_COLUMN]
+    cadastre_gdf = cadastre_gdf[columns + [cadastre_gdf.geometry.name]]
+    if path.splitext(dst_filepath)[1] == '.parquet':
+        cadastre_gdf.to_parquet(
+            dst_filepath,
+            index=False,
+            write_covering_bbox=True,
+            row_group_size=row_group_size)
+    else:
+        cadastre_gdf.to_file(dst_filepath, engine='pyogrio')
+
+
+def read_cadastre(cadastre_filepath, bbox=None, columns=None):
+    # read (the features within `bbox` of) the cadastre with arrow, only
+    # loading the LULC column and the geometry by default. GeoParquet row
+    # groups and GeoPackage R-tree nodes outside `bbox` are skipped
+    if columns is None:
+        columns = [CADASTRE_LULC_COLUMN]
+    if path.splitext(cadastre_filepath)[1] == '.parquet':
+        return gpd.read_parquet(cadastre_filepath,
+                                columns=columns + ['geometry'],
+                                bbox=bbox)
+    return gpd.read_file(cadastre_filepath,
+                         bbox=bbox,
+                         columns=columns,
+                         engine='pyogrio',
+                         use_arrow=True)
@@ -0,0 +1,60 @@
+import contextlib
+import functools
+from concurrent import futures
+
+import dask
+from dask import multiprocessing
+
+SCHEDULERS = [
+    'processes', 'threads', 'synchronous', 'distributed', 'process-pool',
+    'thread-pool'
+]
+
+
+@contextlib.contextmanager
+def scheduler_context(scheduler='processes',
+                      n_workers=None,
+                      threads_per_worker=None,
+                      memory_limit=None,
+                      address=None):
+    # set the dask scheduler used within the context. The `distributed`
+    # scheduler (implied if `address` is provided) connects to the cluster at
+    # `address` or otherwise starts a local cluster whose workers spill their
+    # results to disk when they approach `memory_limit`. The `*-pool`
+    # schedulers run the tasks in a `concurrent.futures` executor, whose
+    # processes are started like those of dask's `processes` scheduler, i.e.,
+    # spawned by default rather than forked from a (multithreaded) process
+    if scheduler == 'distributed' or address is not None:
+        # optional dependency, only required for this scheduler
+        from dask import distributed
+
+        with contextlib.ExitStack() as stack:
+            if address is None:
+                address = stack.enter_context(
+                    distributed.LocalCluster(
+                        n_workers=n_workers,
+                        threads_per_worker=threads_per_worker,
+                        memory_limit=memory_limit or 'auto'))
+            # the client sets itself as the default scheduler
+            stack.enter_context(distributed.Client(address))
+            yield
+    elif scheduler == 'process-pool':
+        with futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context()) as executor:
+            # use dask's multiprocessing get so that tasks are cloudpickled
+            with dask.config.set(scheduler=functools.partial(
+                    multiprocessing.get, pool=executor)):
+                yield
+    elif scheduler == 'thread-pool':
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            with dask.config.set(scheduler=executor):
+                yield
+    else:
+        with dask.config.set(scheduler=scheduler, num_workers=n_workers):
+            yield
+
+
+def get_scheduler(default='processes'):
+    # scheduler set by `scheduler_context` (or a distributed client), if any
+    return dask.config.get('scheduler', default)
@@ -0,0 +1,160 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import uuid
+from os import path
+
+MB = 1024**2
+
+
+def get_file_digest(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as src:
+        for chunk in iter(lambda: src.read(MB), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_or_copy(src_filepath, dst_filepath):
+    # hard link `src_filepath` to `dst_filepath`, or copy it if it is not
+    # possible (e.g., across file systems)
+    if path.lexists(dst_filepath):
+        os.remove(dst_filepath)
+    try:
+        os.link(src_filepath, dst_filepath)
+    except OSError:
+        shutil.copyfile(src_filepath, dst_filepath)
+
+
+# content-addressed cache of downloaded files, which can be shared across
+# checkouts. Files are stored (read-only) by their SHA-256 digest under
+# `objects`, and each source, e.g., a URL or an S3 key and ETag, refers to
+# the digest of its content under `refs`. Since objects are hard linked into
+# the checkouts, their last use is tracked by touching an empty file of the
+# same name under `access` rather than the objects themselves, which would
+# change the modification time of the linked files (and trigger rebuilds)
+class DataCache:
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        # maximum size of the cache (in bytes), `None` means unbounded
+        self.max_size = max_size
+        self.objects_dir = path.join(cache_dir, 'objects')
+        self.refs_dir = path.join(cache_dir, 'refs')
+        self.access_dir = path.join(cache_dir, 'access')
+        self.tmp_dir = path.join(cache_dir, 'tmp')
+        for _dir in [
+                self.objects_dir, self.refs_dir, self.access_dir, self.tmp_dir
+        ]:
+            os.makedirs(_dir, exist_ok=True)
+
+    @staticmethod
+    def get_ref_key(source):
+        return hashlib.sha256(
+            json.dumps(source, sort_keys=True).encode()).hexdigest()
+
+    def _get_object_filepath(self, digest):
+        return path.join(self.objects_dir, digest)
+
+    def _touch(self, digest):
+        # mark the object as the last to be evicted (LRU)
+        with open(path.join(self.access_dir, digest), 'a'):
+            pass
+        os.utime(path.join(self.access_dir, digest))
+
+    def get_tmp_filepath(self, source):
+        # stable (per source) temporary path to download to, so that
+        # interrupted downloads can be resumed. Concurrent downloads of the
+        # same source must hold its `lock`
+        return path.join(self.tmp_dir, self.get_ref_key(source))
+
+    @contextlib.contextmanager
+    def lock(self, source):
+        # exclusive lock of a source across processes (and threads, since each
+        # call opens its own lock file description), held while downloading
+        # it to its temporary path and adding it to the cache
+        with open(f'{self.get_tmp_filepath(source)}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, source=None, digest=None):
+        # path of the cached content of `source` (or with the given digest),
+        # or `None` if it is not cached
+        if digest is None:
+            try:
+                with open(path.join(self.refs_dir,
+                                    self.get_ref_key(source))) as src:
+                    digest = src.read().strip()
+            except FileNotFoundError:
+                return None
+        object_filepath = self._get_object_filepath(digest)
+        if not path.exists(object_filepath):
+            return None
+        self._touch(digest)
+        return object_filepath
+
+    def add(self, source, filepath, digest=None):
+        # move `filepath` into the cache as the content of `source` (checking
+        # it against `digest` if provided) and return its cached path
+        file_digest = get_file_digest(filepath)
+        if digest is not None and file_digest != digest:
+            os.remove(filepath)
+            raise ValueError(f"the content of {source} does not match its "
+                             f"SHA-256 digest {digest}")
+        object_filepath = self._get_object_filepath(file_digest)
+        os.chmod(filepath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(filepath, object_filepath)
+        # write to a temporary file and rename so that refs are atomic
+        ref_filepath = path.join(self.refs_dir, self.get_ref_key(source))
+        tmp_filepath = f'{ref_filepath}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filepath, 'w') as dst:
+            dst.write(file_digest)
+        os.replace(tmp_filepath, ref_filepath)
+        self._touch(file_digest)
+        self.evict(keep=object_filepath)
+        return object_filepath
+
+    def _get_entries(self):
+        # (last use, size, path) of the objects, skipping those removed by
+        # other processes (sharing the cache) while listing them. Objects
+        # without an access file were last used when they were added
+        for entry in os.scandir(self.objects_dir):
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            try:
+                last_use = os.stat(path.join(self.access_dir,
+                                             entry.name)).st_mtime
+            except FileNotFoundError:
+                last_use = entry_stat.st_mtime
+            yield last_use, entry_stat.st_size, entry.path
+
+    def evict(self, keep=None):
+        # remove the least recently used objects (but `keep`) until the cache
+        # fits in `max_size`. Refs to evicted objects are simply misses
+        if self.max_size is None:
+            return
+        entries = sorted(self._get_entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, filepath in entries:
+            if size <= self.max_size:
+                break
+            if filepath == keep:
+                continue
+            for _filepath in [
+                    filepath,
+                    path.join(self.access_dir, path.basename(filepath))
+            ]:
+                try:
+                    os.remove(_filepath)
+                except FileNotFoundError:
+                    # evicted by another process
+                    pass
+            size -= entry_size
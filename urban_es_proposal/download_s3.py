@@ -1,18 +1,266 @@
+import hashlib
+import json
 import logging
+import os
 import sys
-from os import environ
+import threading
+from concurrent import futures
+from os import environ, path
 
 import boto3
 import botocore
 import click
 import dotenv
+from boto3.s3 import transfer
 from tqdm import tqdm
 
+MB = 1024**2
+# defaults of the transfer configuration
+PART_SIZE = 8 * MB
+MAX_CONCURRENCY = 10
+# attempts to download each part before giving up (progress is kept so that
+# the download can be resumed)
+MAX_ATTEMPTS = 5
+# errors raised while streaming the body of a ranged GET, after which the part
+# is downloaded again
+RETRY_ERRORS = (botocore.exceptions.IncompleteReadError,
+                botocore.exceptions.ResponseStreamingError,
+                botocore.exceptions.ReadTimeoutError,
+                botocore.exceptions.ConnectionError)
+
+
+def get_client():
+    session = boto3.Session(profile_name=environ.get('S3_PROFILE_NAME'))
+    return session.client(
+        's3',
+        # if using DigitalOcean Spaces instead of AWS S3
+        endpoint_url=environ.get('S3_ENDPOINT_URL'),
+    )
+
+
+def get_local_etag(filepath, part_size=None):
+    # S3 ETag of a local file, i.e., the MD5 of its content or, for multipart
+    # uploads (if `part_size` is provided), the MD5 of the MD5s of its parts
+    # followed by the number of parts
+    with open(filepath, 'rb') as src:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: src.read(MB), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        part_digests = [
+            hashlib.md5(chunk).digest()
+            for chunk in iter(lambda: src.read(part_size), b'')
+        ]
+    return '{}-{}'.format(
+        hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+def get_etag_part_sizes(size, num_parts, part_size=None):
+    # candidate part sizes of a multipart upload of `num_parts`: the size of
+    # the transfer configuration, the common defaults of S3 clients and the
+    # smallest whole number of MB that fits the size in `num_parts`
+    part_sizes = [part_size] if part_size else []
+    part_sizes += [5 * MB, 8 * MB, 15 * MB, 16 * MB, 64 * MB, 100 * MB]
+    part_sizes.append(-(-size // num_parts // MB) * MB)
+    return [
+        part_size for part_size in dict.fromkeys(part_sizes)
+        if -(-size // part_size) == num_parts
+    ]
+
+
+def etag_matches(filepath, etag, part_size=None):
+    # whether the content of the local file matches the S3 ETag (`None` if
+    # it cannot be checked, e.g., ETags of encrypted objects are not MD5s)
+    etag = etag.strip('"')
+    if '-' not in etag:
+        return get_local_etag(filepath) == etag if len(etag) == 32 else None
+    size = path.getsize(filepath)
+    part_sizes = get_etag_part_sizes(size,
+                                     int(etag.split('-')[1]),
+                                     part_size=part_size)
+    if not part_sizes:
+        return None
+    return any(
+        get_local_etag(filepath, part_size=part_size) == etag
+        for part_size in part_sizes)
+
+
+def is_downloaded(dst_filepath, size, etag, verify=True):
+    # whether `dst_filepath` already has the content of the object
+    if not path.exists(dst_filepath) or path.getsize(dst_filepath) != size:
+        return False
+    return not verify or etag_matches(dst_filepath, etag) is not False
+
+
+class PartialDownload:
+    # download state stored next to the partial file so that an interrupted
+    # download can be resumed with ranged GETs of the parts that are missing,
+    # as long as the object (i.e., its ETag) and the part size did not change
+    def __init__(self, dst_filepath, size, etag, part_size):
+        self.filepath = f'{dst_filepath}.part'
+        self.state_filepath = f'{self.filepath}.json'
+        self.state = dict(size=size, etag=etag, part_size=part_size, parts=[])
+        self._lock = threading.Lock()
+        try:
+            with open(self.state_filepath) as src:
+                state = json.load(src)
+        except (OSError, ValueError):
+            state = None
+        if state is not None and path.exists(self.filepath) and all(
+                state.get(key) == self.state[key]
+                for key in ['size', 'etag', 'part_size']):
+            self.state = state
+        else:
+            # (re)start from scratch with a preallocated file
+            with open(self.filepath, 'wb') as dst:
+                dst.truncate(size)
+            self._dump_state()
+
+    def _dump_state(self):
+        with open(self.state_filepath, 'w') as dst:
+            json.dump(self.state, dst)
+
+    @property
+    def missing_parts(self):
+        num_parts = -(-self.state['size'] // self.state['part_size'])
+        return sorted(set(range(num_parts)) - set(self.state['parts']))
+
+    @property
+    def downloaded_size(self):
+        return sum(
+            min(self.state['part_size'],
+                self.state['size'] - part * self.state['part_size'])
+            for part in self.state['parts'])
+
+    def write_part(self, part, body):
+        with open(self.filepath, 'r+b') as dst:
+            dst.seek(part * self.state['part_size'])
+            dst.write(body)
+        with self._lock:
+            self.state['parts'].append(part)
+            self._dump_state()
+
+    def finalize(self, dst_filepath):
+        os.replace(self.filepath, dst_filepath)
+        os.remove(self.state_filepath)
+
+    def discard(self):
+        for filepath in [self.filepath, self.state_filepath]:
+            if path.exists(filepath):
+                os.remove(filepath)
+
+
+def download_part(client,
+                  bucket_name,
+                  file_key,
+                  partial_download,
+                  part,
+                  max_attempts=MAX_ATTEMPTS,
+                  callback=None):
+    # ranged GET of a part (only if the object still has the same ETag),
+    # retrying if the stream is interrupted
+    size, part_size = partial_download.state['size'], partial_download.state[
+        'part_size']
+    start = part * part_size
+    end = min(start + part_size, size) - 1
+    for attempt in range(1, max_attempts + 1):
+        try:
+            body = client.get_object(Bucket=bucket_name,
+                                     Key=file_key,
+                                     Range=f'bytes={start}-{end}',
+                                     IfMatch=partial_download.state['etag'])[
+                                         'Body'].read()
+            break
+        except RETRY_ERRORS:
+            if attempt == max_attempts:
+                raise
+    partial_download.write_part(part, body)
+    if callback is not None:
+        callback(len(body))
+
+
+def download(client,
+             bucket_name,
+             file_key,
+             dst_filepath,
+             config=None,
+             max_attempts=MAX_ATTEMPTS,
+             verify=True,
+             callback=None,
+             etag=None):
+    # download an object with concurrent ranged GETs of its parts, resuming
+    # a previously interrupted download (if any), skipping it if
+    # `dst_filepath` already matches the object and verifying the ETag of the
+    # result. If `etag` is given, the download is pinned to that content,
+    # i.e., it fails (with a 412 error) if the object has changed since.
+    # Returns whether the object was (at least partially) downloaded
+    logger = logging.getLogger(__name__)
+    if config is None:
+        config = transfer.TransferConfig(multipart_chunksize=PART_SIZE,
+                                         max_concurrency=MAX_CONCURRENCY)
+
+    head_kws = {} if etag is None else dict(IfMatch=etag)
+    head = client.head_object(Bucket=bucket_name, Key=file_key, **head_kws)
+    size, etag = head['ContentLength'], head['ETag']
+    if is_downloaded(dst_filepath, size, etag, verify=verify):
+        logger.info("%s already matches key %s, skipping download",
+                    dst_filepath, file_key)
+        return False
+
+    partial_download = PartialDownload(dst_filepath, size, etag,
+                                       config.multipart_chunksize)
+    if partial_download.state['parts']:
+        logger.info("resuming download of key %s from %d bytes", file_key,
+                    partial_download.downloaded_size)
+    if callback is not None:
+        callback(partial_download.downloaded_size)
+    with futures.ThreadPoolExecutor(
+            max_workers=config.max_concurrency) as executor:
+        for future in [
+                executor.submit(download_part,
+                                client,
+                                bucket_name,
+                                file_key,
+                                partial_download,
+                                part,
+                                max_attempts=max_attempts,
+                                callback=callback)
+                for part in partial_download.missing_parts
+        ]:
+            future.result()
+
+    if verify and etag_matches(partial_download.filepath, etag,
+                               part_size=config.multipart_chunksize) is False:
+        partial_download.discard()
+        raise ValueError(
+            f"the downloaded content of {file_key} does not match its ETag")
+    partial_download.finalize(dst_filepath)
+    return True
+
 
 @click.command()
 @click.argument('file_key')
 @click.argument('output_filepath', type=click.Path())
-def main(file_key, output_filepath):
+@click.option('--part-size',
+              type=int,
+              default=PART_SIZE // MB,
+              required=False,
+              help='Size (in MB) of the parts downloaded with ranged GETs')
+@click.option('--max-concurrency',
+              type=int,
+              default=MAX_CONCURRENCY,
+              required=False,
+              help='Number of parts downloaded concurrently')
+@click.option('--max-attempts',
+              type=int,
+              default=MAX_ATTEMPTS,
+              required=False)
+@click.option('--verify/--no-verify',
+              default=True,
+              help='Verify the downloaded content against the ETag')
+def main(file_key, output_filepath, part_size, max_concurrency, max_attempts,
+         verify):
     logger = logging.getLogger(__name__)
 
     # callback to display a tqdm progress bar for file downloads
@@ -22,13 +270,10 @@ def main(file_key, output_filepath):
 
         return inner
 
-    session = boto3.Session(profile_name=environ.get('S3_PROFILE_NAME'))
-    client = session.client(
-        's3',
-        # if using DigitalOcean Spaces instead of AWS S3
-        endpoint_url=environ.get('S3_ENDPOINT_URL'),
-    )
+    client = get_client()
     BUCKET_NAME = environ.get('S3_BUCKET_NAME')
+    config = transfer.TransferConfig(multipart_chunksize=part_size * MB,
+                                     max_concurrency=max_concurrency)
 
     try:
         logger.info("downloading key %s from %s", file_key, BUCKET_NAME)
@@ -36,20 +281,25 @@ def main(file_key, output_filepath):
                                       Key=file_key)['ContentLength']
         with tqdm(total=filesize, unit='B', unit_scale=True,
                   desc=file_key) as t:
-            client.download_file(BUCKET_NAME,
-                                 file_key,
-                                 output_filepath,
-                                 Callback=hook(t))
-            logger.info("file %s successfully downloaded to %s", file_key,
-                        output_filepath)
+            if download(client,
+                        BUCKET_NAME,
+                        file_key,
+                        output_filepath,
+                        config=config,
+                        max_attempts=max_attempts,
+                        verify=verify,
+                        callback=hook(t)):
+                logger.info("file %s successfully downloaded to %s",
+                            file_key, output_filepath)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             logger.exception("the object %s does not exist", file_key)
             sys.exit(1)
         else:
             raise
-    except botocore.exceptions.IncompleteReadError as e:
+    except RETRY_ERRORS as e:
         logger.exception(e)
+        logger.info("run the command again to resume the download")
         sys.exit(1)
 
 
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import urllib.request
+from concurrent import futures
+from os import environ, path
+
+import click
+import dotenv
+
+from urban_es_proposal import data_cache, download_s3, settings
+
+# default location of the data cache shared across checkouts
+DATA_CACHE_DIR = path.join(path.expanduser('~'), '.cache',
+                           'urban-es-proposal')
+MAX_WORKERS = 4
+
+
+def download_url(url, dst_filepath):
+    # stream the content of `url` to `dst_filepath`
+    with urllib.request.urlopen(url) as response, open(dst_filepath,
+                                                       'wb') as dst:
+        shutil.copyfileobj(response, dst, length=download_s3.MB)
+
+
+def get_s3_source(client, bucket_name, file_key):
+    # the ETag identifies the content of an S3 key
+    return dict(s3_bucket=bucket_name,
+                s3_key=file_key,
+                etag=client.head_object(Bucket=bucket_name,
+                                        Key=file_key)['ETag'])
+
+
+def download_entry(entry, source, digest, cache, client, bucket_name):
+    # download a manifest entry to its temporary path and add it to the
+    # cache. S3 downloads are pinned to the ETag of the source, so that the
+    # cached content is the one that the source names
+    tmp_filepath = cache.get_tmp_filepath(source)
+    if 's3_key' in entry:
+        download_s3.download(client,
+                             bucket_name,
+                             entry['s3_key'],
+                             tmp_filepath,
+                             etag=source['etag'])
+    else:
+        download_url(entry['url'], tmp_filepath)
+    return cache.add(source, tmp_filepath, digest=digest)
+
+
+def fetch_entry(entry, cache, get_client, bucket_name=None):
+    # fetch the `url` or `s3_key` of a manifest entry into the cache (unless
+    # it is already there) and link it to its `dst` path. Returns whether it
+    # was downloaded
+    if 's3_key' in entry:
+        client = get_client()
+        source = get_s3_source(client, bucket_name, entry['s3_key'])
+    else:
+        client = None
+        source = dict(url=entry['url'])
+    digest = entry.get('sha256')
+    object_filepath = cache.get(source=source, digest=digest)
+    downloaded = False
+    if object_filepath is None:
+        with cache.lock(source):
+            # another process (or thread) may have fetched the source while
+            # waiting for the lock
+            object_filepath = cache.get(source=source, digest=digest)
+            if object_filepath is None:
+                object_filepath = download_entry(entry, source, digest,
+                                                 cache, client, bucket_name)
+                downloaded = True
+
+    os.makedirs(path.dirname(entry['dst']) or '.', exist_ok=True)
+    data_cache.link_or_copy(object_filepath, entry['dst'])
+    return downloaded
+
+
+def fetch_manifest(manifest, cache, max_workers=MAX_WORKERS):
+    # fetch the manifest entries concurrently, returning the entries that
+    # failed (with their exception)
+    logger = logging.getLogger(__name__)
+    clients = []
+
+    def get_client():
+        # only create the (thread-safe) S3 client if needed
+        if not clients:
+            clients.append(download_s3.get_client())
+        return clients[0]
+
+    failed = []
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_entry = {
+            executor.submit(fetch_entry,
+                            entry,
+                            cache,
+                            get_client,
+                            bucket_name=environ.get('S3_BUCKET_NAME')):
+            entry
+            for entry in manifest
+        }
+        for future in futures.as_completed(future_to_entry):
+            entry = future_to_entry[future]
+            try:
+                downloaded = future.result()
+            except Exception as e:
+                logger.exception("could not fetch %s", entry['dst'])
+                failed.append((entry, e))
+                continue
+            logger.info("%s %s", "downloaded" if downloaded else "linked",
+                        entry['dst'])
+
+    return failed
+
+
+@click.command()
+@click.argument('manifest_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepaths', nargs=-1)
+@click.option('--cache-dir',
+              type=click.Path(),
+              envvar='DATA_CACHE_DIR',
+              default=DATA_CACHE_DIR,
+              required=False,
+              help='Data cache directory, which can be shared across '
+              'checkouts')
+@click.option('--cache-max-size',
+              type=int,
+              required=False,
+              help='Maximum size of the data cache (in MB)')
+@click.option('--max-workers',
+              type=int,
+              default=MAX_WORKERS,
+              required=False,
+              help='Number of files fetched concurrently')
+def main(manifest_filepath, dst_filepaths, cache_dir, cache_max_size,
+         max_workers):
+    logger = logging.getLogger(__name__)
+
+    # read the manifest, i.e., a list of entries with a `dst` path and either
+    # a `url` or an `s3_key` (and optionally its `sha256` digest), and keep
+    # only the `dst_filepaths` entries (if provided)
+    with open(manifest_filepath) as src:
+        manifest = json.load(src)
+    if dst_filepaths:
+        manifest = [
+            entry for entry in manifest
+            if path.normpath(entry['dst']) in map(path.normpath,
+                                                  dst_filepaths)
+        ]
+        if len(manifest) < len(dst_filepaths):
+            logger.error("some of %s are not in manifest %s",
+                         ', '.join(dst_filepaths), manifest_filepath)
+            sys.exit(1)
+
+    cache = data_cache.DataCache(
+        cache_dir,
+        max_size=cache_max_size *
+        download_s3.MB if cache_max_size is not None else None)
+    failed = fetch_manifest(manifest, cache, max_workers=max_workers)
+    if failed:
+        sys.exit(1)
+    logger.info("fetched %d files using the data cache at %s", len(manifest),
+                cache_dir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=settings.DEFAULT_LOG_FMT)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    dotenv.load_dotenv(dotenv.find_dotenv())
+
+    main()
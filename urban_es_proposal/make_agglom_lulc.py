@@ -1,12 +1,12 @@
 import logging
+from os import path
 
 import click
 import geopandas as gpd
 import numpy as np
-import rasterio as rio
 from rasterio import features, transform, windows
 
-from urban_es_proposal import settings
+from urban_es_proposal import cadastre_utils, raster_utils, settings
 
 LAUSANNE_LULC_FILE_REGEX_PATTERN = "Cadastre/(NPCS|MOVD)_CAD_TPR_(BATHS|" \
                            "CSBOIS|CSDIV|CSDUR|CSEAU|CSVERT)_S.*"
@@ -21,31 +21,211 @@ CRS = 'epsg:2056'
 CADASTRE_LULC_COLUMN = 'GENRE'
 
 
-def _lausanne_reclassify(value, dst_nodata):
-    if value < 0:
-        return dst_nodata
-    if value >= 9:
-        return value - 1
-    else:
-        return value
+def lausanne_reclassify(value_arr, dst_nodata):
+    # vectorized reclassification of the cadastre LULC codes: negative codes
+    # are nodata and codes from 9 onwards are shifted down by one
+    value_arr = np.asarray(value_arr)
+    return np.where(value_arr < 0, dst_nodata,
+                    np.where(value_arr >= 9, value_arr - 1, value_arr))
 
 
-def rasterize_cadastre(cadastre_gdf, dst_res, dst_nodata, dst_dtype):
-    cadastre_ser = cadastre_gdf[CADASTRE_LULC_COLUMN].apply(
-        _lausanne_reclassify, args=(dst_nodata, ))
-    cadastre_transform = transform.from_origin(WEST + dst_res // 2,
-                                               NORTH - dst_res // 2, dst_res,
+def get_extent_window(extent_geom, dst_res, grid_res=None):
+    # window of the (hardcoded) cadastre grid that covers the bounds of the
+    # extent geometry. The grid has its origin half a `grid_res` pixel within
+    # the cadastre's north-west corner (by default `grid_res` is `dst_res`,
+    # i.e., the grid of a plain rasterization at `dst_res`), so that the grids
+    # of all the resolutions that share a `grid_res` have a common origin and
+    # the pixels of each of them tile those of its multiples
+    if grid_res is None:
+        grid_res = dst_res
+    cadastre_transform = transform.from_origin(WEST + grid_res // 2,
+                                               NORTH - grid_res // 2, dst_res,
                                                dst_res)
-    cadastre_shape = ((NORTH - SOUTH) // dst_res, (EAST - WEST) // dst_res)
-    cadastre_arr = features.rasterize(
-        ((geom, value)
-         for geom, value in zip(cadastre_gdf['geometry'], cadastre_ser)),
-        out_shape=cadastre_shape,
-        fill=dst_nodata,
-        transform=cadastre_transform,
-        dtype=dst_dtype)
+    cadastre_window = windows.Window(0, 0, (EAST - WEST) // dst_res,
+                                     (NORTH - SOUTH) // dst_res)
+    bounds_window = windows.from_bounds(*extent_geom.total_bounds,
+                                        transform=cadastre_transform)
+    # round the start (end) of the window down (up) to whole pixels
+    col_off, row_off = np.floor([bounds_window.col_off,
+                                 bounds_window.row_off]).astype(int)
+    col_end, row_end = np.ceil([
+        bounds_window.col_off + bounds_window.width,
+        bounds_window.row_off + bounds_window.height
+    ]).astype(int)
+    extent_window = windows.Window(col_off, row_off, col_end - col_off,
+                                   row_end - row_off).intersection(
+                                       cadastre_window)
+    return extent_window, windows.transform(extent_window, cadastre_transform)
 
-    return cadastre_arr, cadastre_transform
+
+def rasterize_cadastre(cadastre_gdf, out_shape, cadastre_transform,
+                       dst_nodata, dst_dtype):
+    cadastre_arr = lausanne_reclassify(cadastre_gdf[CADASTRE_LULC_COLUMN],
+                                       dst_nodata)
+    return features.rasterize(zip(cadastre_gdf['geometry'], cadastre_arr),
+                              out_shape=out_shape,
+                              fill=dst_nodata,
+                              transform=cadastre_transform,
+                              dtype=dst_dtype)
+
+
+def rasterize_extent_mask(agglom_extent_geom,
+                          dst_res,
+                          grid_res=None,
+                          extent_nodata=0):
+    # get the window of the cadastre grid that covers the extent and
+    # rasterize the extent mask within it, then shrink the window to the
+    # valid data points, i.e., the computed extent
+    bounds_window, bounds_transform = get_extent_window(
+        agglom_extent_geom, dst_res, grid_res=grid_res)
+    agglom_extent_mask = features.rasterize(
+        agglom_extent_geom,
+        out_shape=(bounds_window.height, bounds_window.width),
+        fill=extent_nodata,
+        transform=bounds_transform)
+    data_window = windows.get_data_window(agglom_extent_mask,
+                                          nodata=extent_nodata)
+    return agglom_extent_mask[windows.window_index(
+        data_window)] != extent_nodata, windows.transform(
+            data_window, bounds_transform)
+
+
+def aggregate_mode(lulc_arr, factor, dst_nodata):
+    # aggregate blocks of `factor` x `factor` pixels to their most frequent
+    # (mode) value, counting nodata as a value so that the pixels mostly
+    # outside the extent are nodata. Ties go to the lowest value. Incomplete
+    # blocks at the end of the rows and columns are padded with nodata
+    height, width = (-(-size // factor) for size in lulc_arr.shape)
+    block_arr = np.pad(lulc_arr,
+                       ((0, height * factor - lulc_arr.shape[0]),
+                        (0, width * factor - lulc_arr.shape[1])),
+                       constant_values=dst_nodata).reshape(
+                           height, factor, width, factor)
+    mode_arr = np.full((height, width), dst_nodata, dtype=lulc_arr.dtype)
+    mode_count_arr = np.zeros((height, width), dtype=int)
+    for value in np.unique(lulc_arr):
+        count_arr = (block_arr == value).sum(axis=(1, 3))
+        cond = count_arr > mode_count_arr
+        mode_arr[cond] = value
+        mode_count_arr[cond] = count_arr[cond]
+    return mode_arr
+
+
+def aggregate_to_grid(base_arr, base_transform, factor, dst_shape,
+                      dst_transform, dst_nodata):
+    # mode-aggregate a LULC array onto a coarser grid with a common origin,
+    # i.e., whose pixels are tiled by blocks of `factor` x `factor` pixels of
+    # the finer grid, padding with nodata beyond its bounds
+    col_off, row_off = (round(off) for off in ~base_transform *
+                        (dst_transform.c, dst_transform.f))
+    height, width = dst_shape
+    block_window = windows.Window(col_off, row_off, width * factor,
+                                  height * factor)
+    block_arr = np.full((block_window.height, block_window.width),
+                        dst_nodata,
+                        dtype=base_arr.dtype)
+    try:
+        base_window = block_window.intersection(
+            windows.Window(0, 0, base_arr.shape[1], base_arr.shape[0]))
+    except windows.WindowError:
+        # no overlap, i.e., all nodata
+        return aggregate_mode(block_arr, factor, dst_nodata)
+    block_arr[windows.window_index(
+        windows.Window(base_window.col_off - block_window.col_off,
+                       base_window.row_off - block_window.row_off,
+                       base_window.width, base_window.height))] = base_arr[
+                           windows.window_index(base_window)]
+    return aggregate_mode(block_arr, factor, dst_nodata)
+
+
+def get_agglom_lulc_arrs(cadastre_gdf,
+                         agglom_extent_geom,
+                         dst_ress,
+                         dst_nodata,
+                         dst_dtype,
+                         grid_res=None,
+                         rasterize_ress=()):
+    # LULC arrays (and their transforms) at each resolution, from the finest
+    # to the coarsest, all on cadastre grids with the common origin of
+    # `grid_res` (by default the finest resolution). The finest resolution,
+    # the ones in `rasterize_ress` and the ones that no finer resolution
+    # divides are rasterized from the cadastre. Every other resolution is
+    # mode-aggregated from the coarsest (already computed) one that divides
+    # it, which is the cheapest
+    if grid_res is None:
+        grid_res = min(dst_ress)
+    agglom_lulc_arrs = {}
+    for dst_res in sorted(dst_ress):
+        agglom_extent_mask, extent_transform = rasterize_extent_mask(
+            agglom_extent_geom, dst_res, grid_res=grid_res)
+        base_ress = [
+            base_res for base_res in agglom_lulc_arrs
+            if dst_res % base_res == 0
+        ]
+        if base_ress and dst_res not in rasterize_ress:
+            dst_arr = aggregate_to_grid(*agglom_lulc_arrs[base_ress[-1]],
+                                        dst_res // base_ress[-1],
+                                        agglom_extent_mask.shape,
+                                        extent_transform, dst_nodata)
+        else:
+            dst_arr = rasterize_cadastre(cadastre_gdf,
+                                         agglom_extent_mask.shape,
+                                         extent_transform, dst_nodata,
+                                         dst_dtype)
+        dst_arr[~agglom_extent_mask] = dst_nodata
+        agglom_lulc_arrs[dst_res] = dst_arr, extent_transform
+        yield dst_res, agglom_lulc_arrs[dst_res]
+
+
+def dump_agglom_lulc(dst_arr, dst_transform, dst_filepath, dst_nodata,
+                     dst_dtype, compress=None):
+    with raster_utils.open_raster(
+            dst_filepath,
+            profile='categorical',
+            compress=compress,
+            width=dst_arr.shape[1],
+            height=dst_arr.shape[0],
+            count=1,
+            crs=CRS,  # cadastre_gdf.crs
+            transform=dst_transform,
+            dtype=dst_dtype,
+            nodata=dst_nodata) as dst:
+        dst.write(dst_arr, 1)
+
+
+def dump_agglom_lulc_pyramid(cadastre_gdf,
+                             agglom_extent_geom,
+                             dst_filepath,
+                             dst_res=10,
+                             dst_nodata=255,
+                             dst_dtype='uint8',
+                             pyramid_ress=(),
+                             compress='deflate'):
+    # rasterize the cadastre at `dst_res` (so that `dst_filepath` does not
+    # depend on `pyramid_ress`) and get the `pyramid_ress` on grids with the
+    # same origin as the one of `dst_res`, aggregating the finer resolutions
+    # that divide them (or rasterizing them otherwise), dumping them next to
+    # `dst_filepath`
+    logger = logging.getLogger(__name__)
+    root, ext = path.splitext(dst_filepath)
+    for _dst_res, (dst_arr, dst_transform) in get_agglom_lulc_arrs(
+            cadastre_gdf,
+            agglom_extent_geom, {dst_res, *pyramid_ress},
+            dst_nodata,
+            dst_dtype,
+            grid_res=dst_res,
+            rasterize_ress={dst_res}):
+        logger.info("computed LULC dataset at %dm to shape %s", _dst_res,
+                    str(dst_arr.shape))
+        _dst_filepath = dst_filepath if _dst_res == dst_res else \
+            f'{root}-{_dst_res}m{ext}'
+        dump_agglom_lulc(dst_arr,
+                         dst_transform,
+                         _dst_filepath,
+                         dst_nodata,
+                         dst_dtype,
+                         compress=compress)
+        logger.info("dumped rasterized dataset to %s", _dst_filepath)
 
 
 @click.command()
@@ -55,47 +235,39 @@ def rasterize_cadastre(cadastre_gdf, dst_res, dst_nodata, dst_dtype):
 @click.option('--dst-res', type=int, default=10, required=False)
 @click.option('--dst-nodata', type=int, default=255, required=False)
 @click.option('--dst-dtype', default='uint8', required=False)
+@click.option('--pyramid-res',
+              'pyramid_ress',
+              type=int,
+              multiple=True,
+              help='Additional resolution, dumped next to `dst_filepath` '
+              'with a "-<res>m" suffix on a grid with the same origin as the '
+              'one of `--dst-res`, so that the multiples of `--dst-res` are '
+              'mode-aggregated from it. Can be provided multiple times')
+@click.option('--compress',
+              type=click.Choice(raster_utils.COMPRESS_METHODS),
+              default='deflate',
+              required=False)
 def main(cadastre_shp_filepath, agglom_extent_filepath, dst_filepath, dst_res,
-         dst_nodata, dst_dtype):
-    logger = logging.getLogger(__name__)
-
-    cadastre_gdf = gpd.read_file(cadastre_shp_filepath,
-                                 bbox=(WEST, SOUTH, EAST, NORTH))
-
-    # rasterize the cadastre
-    cadastre_arr, cadastre_transform = rasterize_cadastre(
-        cadastre_gdf, dst_res, dst_nodata, dst_dtype)
-    logger.info("rasterized cadastre vector LULC dataset to shape %s",
-                str(cadastre_arr.shape))
-
-    # TODO; crop it to the extent
-    agglom_extent_geom_nodata = 0
+         dst_nodata, dst_dtype, pyramid_ress, compress):
+    # read the extent and the cadastre features within it (once for all the
+    # resolutions)
     agglom_extent_geom = gpd.read_file(
         agglom_extent_filepath)['geometry'].iloc[:1]
-    agglom_extent_mask = features.rasterize(agglom_extent_geom,
-                                            out_shape=cadastre_arr.shape,
-                                            fill=agglom_extent_geom_nodata,
-                                            transform=cadastre_transform)
-    # get window and transform of valid data points, i.e., the computed extent
-    extent_window = windows.get_data_window(agglom_extent_mask,
-                                            nodata=agglom_extent_geom_nodata)
-    extent_transform = windows.transform(extent_window, cadastre_transform)
-    dst_arr = np.where(agglom_extent_mask, cadastre_arr,
-                       dst_nodata)[windows.window_index(extent_window)]
-    # dump it
-    with rio.open(
-            dst_filepath,
-            'w',
-            driver='GTiff',
-            width=extent_window.width,
-            height=extent_window.height,
-            count=1,
-            crs=CRS,  # cadastre_gdf.crs
-            transform=extent_transform,
-            dtype=dst_dtype,
-            nodata=dst_nodata) as dst:
-        dst.write(dst_arr, 1)
-    logger.info("dumped rasterized dataset to %s", dst_filepath)
+    cadastre_gdf = cadastre_utils.read_cadastre(
+        cadastre_shp_filepath,
+        bbox=tuple(
+            agglom_extent_geom.buffer(max({dst_res,
+                                           *pyramid_ress})).total_bounds),
+        columns=[CADASTRE_LULC_COLUMN])
+
+    dump_agglom_lulc_pyramid(cadastre_gdf,
+                             agglom_extent_geom,
+                             dst_filepath,
+                             dst_res=dst_res,
+                             dst_nodata=dst_nodata,
+                             dst_dtype=dst_dtype,
+                             pyramid_ress=pyramid_ress,
+                             compress=compress)
 
 
 if __name__ == '__main__':
@@ -1,71 +1,212 @@
 import logging
+import multiprocessing
+import os
+from concurrent import futures
 
 import click
-import geopandas as gpd
 import numpy as np
 import rasterio as rio
-from rasterio import features, transform
+import shapely
+from rasterio import features, transform, windows
 from skimage.util import shape
 
-from urban_es_proposal import settings
+from urban_es_proposal import cadastre_utils, raster_utils, settings
 
+# side (in pixels of the agglomeration raster) of the tiles processed at once
+TILE_SIZE = 512
+# methods to compute the building cover, i.e., averaging a rasterization at
+# the building resolution or intersecting the building polygons with the
+# pixel grid
+METHODS = ['rasterize', 'exact']
 
-@click.command()
-@click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
-@click.argument('cadastre_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-@click.option('--bldg-res', default=1, required=False)
-@click.option('--dst-dtype', default=None, required=False)
-def main(agglom_lulc_filepath, cadastre_filepath, dst_filepath, bldg_res,
-         dst_dtype):
+
+def get_tile_windows(height, width, tile_size=TILE_SIZE):
+    # row-major tiling of a raster (the last row/column may be smaller)
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield windows.Window(col_off, row_off,
+                                 min(tile_size, width - col_off),
+                                 min(tile_size, height - row_off))
+
+
+def compute_bldg_cover_arr(bldg_geoms, tile_shape, tile_transform, xfactor,
+                           yfactor):
+    # rasterize the buildings of a tile at the building resolution and get the
+    # proportion of building cover of each (agglomeration) pixel
+    # https://bit.ly/2oxiQ80
+    height, width = tile_shape
+    bldg_arr = features.rasterize(((geom, 1) for geom in bldg_geoms),
+                                  out_shape=(height * yfactor,
+                                             width * xfactor),
+                                  fill=0,
+                                  transform=tile_transform,
+                                  dtype=rio.uint8)
+    block_arr = shape.view_as_blocks(bldg_arr, block_shape=(yfactor, xfactor))
+    return block_arr.sum(axis=(2, 3), dtype='uint32') / (xfactor * yfactor)
+
+
+def compute_exact_bldg_cover_arr(bldg_geoms, tile_shape, tile_transform):
+    # exact proportion of building cover of each pixel of a tile, from the
+    # areas of the intersections between the buildings and the pixel polygons.
+    # Building footprints of the cadastre do not overlap, yet the cover is
+    # capped at 1 in case of (slightly) overlapping polygons. Invalid (e.g.,
+    # self-intersecting) footprints are repaired first since GEOS cannot
+    # intersect them
+    height, width = tile_shape
+    row_arr, col_arr = np.divmod(np.arange(height * width), width)
+    xmin_arr, ymax_arr = tile_transform * (col_arr, row_arr)
+    xmax_arr, ymin_arr = tile_transform * (col_arr + 1, row_arr + 1)
+    pixel_geoms = shapely.box(xmin_arr, ymin_arr, xmax_arr, ymax_arr)
+    bldg_geoms = shapely.make_valid(np.asarray(bldg_geoms, dtype=object))
+    bldg_i, pixel_i = shapely.STRtree(pixel_geoms).query(
+        bldg_geoms, predicate='intersects')
+    area_arr = shapely.area(
+        shapely.intersection(bldg_geoms[bldg_i], pixel_geoms[pixel_i]))
+    cover_arr = np.bincount(pixel_i, weights=area_arr,
+                            minlength=height * width) / abs(
+                                tile_transform.a * tile_transform.e)
+    return np.minimum(cover_arr, 1).reshape(tile_shape)
+
+
+def get_tile_task(window, bldg_gser, method, agglom_transform,
+                  bldg_transform, xfactor, yfactor):
+    # function and arguments to compute the building cover of a tile, with
+    # only the buildings that intersect it (according to the spatial index)
+    if method == 'exact':
+        tile_transform = windows.transform(window, agglom_transform)
+        tile_bounds = windows.bounds(window, agglom_transform)
+    else:
+        bldg_window = windows.Window(window.col_off * xfactor,
+                                     window.row_off * yfactor,
+                                     window.width * xfactor,
+                                     window.height * yfactor)
+        tile_transform = windows.transform(bldg_window, bldg_transform)
+        tile_bounds = windows.bounds(bldg_window, bldg_transform)
+    bldg_geoms = bldg_gser.iloc[bldg_gser.sindex.query(
+        shapely.box(*tile_bounds))].tolist()
+    tile_shape = (window.height, window.width)
+    if method == 'exact':
+        return compute_exact_bldg_cover_arr, bldg_geoms, tile_shape, \
+            tile_transform
+    return compute_bldg_cover_arr, bldg_geoms, tile_shape, tile_transform, \
+        xfactor, yfactor
+
+
+def write_tiles(done_futures, future_to_window, src, dst):
+    # write the building cover of the computed tiles (masked by the
+    # agglomeration extract) and forget about them
+    for future in done_futures:
+        window = future_to_window.pop(future)
+        dst.write(np.where(src.dataset_mask(window=window), future.result(),
+                           src.nodata).astype(dst.dtypes[0]),
+                  1,
+                  window=window)
+
+
+def get_bldg_grid(agglom_lulc_filepath, bldg_res):
+    # transform of the building resolution grid (aligned with the pixel
+    # centers of the agglomeration raster) and bbox of the cadastre features
+    # that can fall within the agglomeration pixels
+    with rio.open(agglom_lulc_filepath) as src:
+        xres, yres = src.res
+        west, south, east, north = src.bounds
+    _west = west - (xres / 2 - bldg_res / 2)
+    _north = north + (yres / 2 - bldg_res / 2)
+    bldg_transform = transform.from_origin(_west, _north, bldg_res, bldg_res)
+    return bldg_transform, (_west, south - yres, east + xres, _north)
+
+
+def dump_bldg_cover(agglom_lulc_filepath,
+                    cadastre_gdf,
+                    dst_filepath,
+                    bldg_res=1,
+                    dst_dtype='float64',
+                    tile_size=TILE_SIZE,
+                    method='rasterize',
+                    n_workers=None,
+                    compress='deflate'):
+    # dump the percentage of building cover of each pixel of the
+    # agglomeration raster
     logger = logging.getLogger(__name__)
 
-    # read the agglomeration extract raster
+    # read the agglomeration extract raster metadata
     with rio.open(agglom_lulc_filepath) as src:
-        agglom_mask = src.dataset_mask()
         xres, yres = src.res
         height, width = src.shape
-        west, south, east, north = src.bounds
         meta = src.meta
-        nodata = src.nodata
-
-    # get a binary layer of building pixels at 1m resolution by rasterizing
-    # the cadastre
-    _xres, _yres = bldg_res, bldg_res
-    _west = west - (xres / 2 - _xres / 2)
-    _north = north + (yres / 2 - _yres / 2)
-    gdf = gpd.read_file(cadastre_filepath,
-                        bbox=(_west, south - yres, east + xres, _north))
-    xfactor, yfactor = int(xres // _xres), int(yres // _yres)
-    bldg_shape = (height * yfactor, width * xfactor)
-    bldg_transform = transform.from_origin(_west, _north, _xres, _yres)
-    bldg_gser = gdf[gdf['GENRE'] == 0]['geometry']
-    bldg_arr = features.rasterize(((geom, 1) for geom in bldg_gser),
-                                  out_shape=bldg_shape,
-                                  fill=0,
-                                  transform=bldg_transform,
-                                  dtype=rio.uint8)
-    logger.info("rasterized cadastre from %s to shape %s and resolution %s",
-                cadastre_filepath, bldg_shape, (_xres, _yres))
+        agglom_transform = src.transform
 
-    # get the percentage of building cover of each pixel https://bit.ly/2oxiQ80
-    block_size = xfactor * yfactor
-    block_arr = shape.view_as_blocks(bldg_arr, block_shape=(yfactor, xfactor))
-    bldg_cover_arr = np.sum(block_arr.reshape(block_arr.shape[0],
-                                              block_arr.shape[1], -1),
-                            axis=2) / block_size
-    logger.info("extracted per-pixel proportion of building cover")
-
-    # dump the building cover raster
-    if dst_dtype is None:
-        dst_dtype = bldg_cover_arr.dtype
-    meta.update(dtype=dst_dtype)
-    with rio.open(dst_filepath, 'w', **meta) as dst:
-        dst.write(np.where(agglom_mask, bldg_cover_arr, nodata), 1)
+    # get the building footprints from the cadastre
+    bldg_gser = cadastre_gdf[cadastre_gdf['GENRE'] ==
+                             0]['geometry'].reset_index(drop=True)
+    xfactor, yfactor = int(xres // bldg_res), int(yres // bldg_res)
+    bldg_transform, _ = get_bldg_grid(agglom_lulc_filepath, bldg_res)
+    logger.info("got %d buildings from the cadastre", len(bldg_gser))
 
+    # get the percentage of building cover of each pixel one tile at a time
+    # (in parallel), using the spatial index to only send the buildings of
+    # each tile to the workers. At most two tiles per worker are in flight so
+    # that memory depends on the tile size rather than the extent of the
+    # agglomeration. The workers are spawned rather than forked, since this
+    # can run in a thread of the pipeline while other threads hold locks
+    # (e.g., GDAL's)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    meta.update(dtype=dst_dtype)
+    with rio.open(agglom_lulc_filepath) as src, raster_utils.open_raster(
+            dst_filepath, profile='continuous', compress=compress,
+            **meta) as dst, futures.ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+        future_to_window = {}
+        for window in get_tile_windows(height, width, tile_size=tile_size):
+            if len(future_to_window) >= 2 * n_workers:
+                write_tiles(
+                    futures.wait(future_to_window,
+                                 return_when=futures.FIRST_COMPLETED).done,
+                    future_to_window, src, dst)
+            future_to_window[executor.submit(*get_tile_task(
+                window, bldg_gser, method, agglom_transform, bldg_transform,
+                xfactor, yfactor))] = window
+        write_tiles(list(future_to_window), future_to_window, src, dst)
     logger.info(
-        "dumped raster of per-pixel proportion of building cover to %s",
-        dst_filepath)
+        "dumped raster of per-pixel proportion of building cover (%s method "
+        "in tiles of %d pixels) to %s", method, tile_size, dst_filepath)
+
+
+@click.command()
+@click.argument('agglom_lulc_filepath', type=click.Path(exists=True))
+@click.argument('cadastre_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--bldg-res', default=1, required=False)
+@click.option('--dst-dtype', default='float64', required=False)
+@click.option('--tile-size', default=TILE_SIZE, required=False)
+@click.option('--method',
+              type=click.Choice(METHODS),
+              default='rasterize',
+              required=False,
+              help='Average a rasterization at `--bldg-res` or intersect the '
+              'building polygons with the pixel grid (exact)')
+@click.option('--n-workers', type=int, required=False)
+@click.option('--compress',
+              type=click.Choice(raster_utils.COMPRESS_METHODS),
+              default='deflate',
+              required=False)
+def main(agglom_lulc_filepath, cadastre_filepath, dst_filepath, bldg_res,
+         dst_dtype, tile_size, method, n_workers, compress):
+    # only read the cadastre features around the agglomeration extract
+    _, bbox = get_bldg_grid(agglom_lulc_filepath, bldg_res)
+    cadastre_gdf = cadastre_utils.read_cadastre(cadastre_filepath, bbox=bbox)
+
+    dump_bldg_cover(agglom_lulc_filepath,
+                    cadastre_gdf,
+                    dst_filepath,
+                    bldg_res=bldg_res,
+                    dst_dtype=dst_dtype,
+                    tile_size=tile_size,
+                    method=method,
+                    n_workers=n_workers,
+                    compress=compress)
 
 
 if __name__ == '__main__':
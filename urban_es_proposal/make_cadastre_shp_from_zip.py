@@ -1,9 +1,7 @@
-import glob
 import logging
-import os
 import re
-import shutil
 import zipfile
+from concurrent import futures
 from os import path
 
 import click
@@ -12,7 +10,7 @@ import pandas as pd
 import rasterio as rio
 from rasterio import features, transform
 
-from urban_es_proposal import settings
+from urban_es_proposal import cadastre_utils, settings
 
 LAUSANNE_LULC_FILE_REGEX_PATTERN = "Cadastre/(NPCS|MOVD)_CAD_TPR_(BATHS|" \
                            "CSBOIS|CSDIV|CSDUR|CSEAU|CSVERT)_S.*"
@@ -27,6 +25,50 @@ CRS = 'epsg:2056'
 CADASTRE_LULC_COLUMN = 'GENRE'
 
 
+def get_shp_filepaths(input_filepath, unzip_filepattern):
+    # GDAL virtual paths of the shapefiles of the inner zips (of the outer zip
+    # at `input_filepath`) that match `unzip_filepattern`, which can be read
+    # straight from the nested archives, i.e., without extracting them
+    p = re.compile(unzip_filepattern)
+    input_filepath = path.abspath(input_filepath)
+    shp_filepaths = []
+    with zipfile.ZipFile(input_filepath) as zf:
+        for zip_filename in zf.namelist():
+            if not zip_filename.endswith('.zip'):
+                continue
+            with zipfile.ZipFile(zf.open(zip_filename)) as inner_zf:
+                shp_filepaths += [
+                    f'/vsizip/{{/vsizip/{input_filepath}/{zip_filename}}}/'
+                    f'{filename}' for filename in inner_zf.namelist()
+                    if p.match(filename) and filename.endswith('.shp')
+                ]
+    if not shp_filepaths:
+        raise ValueError(f"no shapefile of the zips within {input_filepath} "
+                         f"matches the pattern {unzip_filepattern!r}")
+
+    return shp_filepaths
+
+
+def read_cadastre_gdf(shp_filepaths, bbox=None, n_workers=None):
+    # read (the LULC column and the features within `bbox` of) the shapefiles
+    # concurrently and assemble them into a single data frame (based on
+    # https://bit.ly/2znOaIh)
+    if not shp_filepaths:
+        raise ValueError("no cadastre shapefile to read")
+    with futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        gdfs = list(
+            executor.map(
+                lambda shp_filepath: gpd.read_file(
+                    shp_filepath,
+                    bbox=bbox,
+                    columns=[CADASTRE_LULC_COLUMN],
+                    engine='pyogrio',
+                    use_arrow=True), shp_filepaths))
+
+    return pd.concat(gdfs, sort=False).pipe(gpd.GeoDataFrame,
+                                            crs=gdfs[0].crs)
+
+
 def _lausanne_reclassify(value, dst_nodata):
     if value < 0:
         return dst_nodata
@@ -54,46 +96,18 @@ def rasterize_cadastre(cadastre_gdf, dst_res, dst_nodata, dst_dtype):
     return cadastre_arr, cadastre_transform
 
 
-@click.command()
-@click.argument('input_filepath', type=click.Path(exists=True))
-@click.argument('dst_filepath', type=click.Path())
-@click.argument('unzip_filepattern')
-def main(input_filepath, dst_filepath, unzip_filepattern):
+def get_cadastre_gdf(input_filepath,
+                     unzip_filepattern,
+                     clip_bbox=True,
+                     n_workers=None):
+    # read the LULC shapefiles of the cadastre zip into a single data frame
     logger = logging.getLogger(__name__)
 
-    # unzip all zip files to temp dirs
-    temp_dir = path.join(path.dirname(dst_filepath), 'temp')
-    if not path.exists(temp_dir):  # and path.isdir(temp_dir):
-        os.mkdir(temp_dir)
-    logger.info("Created temporal directory '%s' to extract the files",
-                temp_dir)
-
-    with zipfile.ZipFile(input_filepath) as zf:
-        zf.extractall(temp_dir)
-    zip_filepaths = glob.glob(path.join(temp_dir, '*.zip'))
-    logger.info("Extracted %d interim zips to %s", len(zip_filepaths),
-                temp_dir)
-
-    for zip_filepath in zip_filepaths:
-        logger.info("Extracting files from %s matching %s", zip_filepath,
-                    unzip_filepattern)
-        p = re.compile(unzip_filepattern)
-
-        with zipfile.ZipFile(zip_filepath) as zf:
-            for file_info in zf.infolist():
-                if p.match(file_info.filename):
-                    filename = '_'.join([
-                        path.splitext(path.basename(zip_filepath))[0],
-                        path.basename(file_info.filename)
-                    ])
-                    # Trick from https://bit.ly/2KZkO9G to manipulate
-                    # zipfile info and junk inner zip paths
-                    file_info.filename = filename
-                    zf.extract(file_info, temp_dir)
-
-    shp_filepaths = glob.glob(path.join(temp_dir, '*.shp'), recursive=True)
+    # find the shapefiles within the inner zips
+    shp_filepaths = get_shp_filepaths(input_filepath, unzip_filepattern)
     logger.info("Assembling single data frame from files: %s",
                 ', '.join(shp_filepaths))
+
     # process 'divers' filepaths later so that the other (more specific)
     # LULC shapefiles take priority
     divers_filepaths = [
@@ -104,19 +118,33 @@ def main(input_filepath, dst_filepath, unzip_filepattern):
         other_filepath for other_filepath in shp_filepaths
         if not other_filepath.endswith('_CSDIV_S.shp')
     ]
-    # Based on https://bit.ly/2znOaIh
-    cadastre_gdf = pd.concat([
-        gpd.read_file(shp_filepath)
-        for shp_filepath in divers_filepaths + other_filepaths
-    ],
-                             sort=False).pipe(gpd.GeoDataFrame)
-    cadastre_gdf.crs = gpd.read_file(shp_filepaths[0]).crs
-    shutil.rmtree(temp_dir)
-    logger.info("deleted temporal directory '%s'", temp_dir)
-
-    # rasterize the cadastre
-    cadastre_gdf.to_file(dst_filepath)
-    logger.info("dumped cadastre shapefile to %s", dst_filepath)
+    return read_cadastre_gdf(
+        divers_filepaths + other_filepaths,
+        bbox=(WEST, SOUTH, EAST, NORTH) if clip_bbox else None,
+        n_workers=n_workers)
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.argument('unzip_filepattern')
+@click.option('--clip-bbox/--no-clip-bbox',
+              default=True,
+              help='Only read the features within the Lausanne bounding box')
+@click.option('--n-workers', type=int, required=False)
+def main(input_filepath, dst_filepath, unzip_filepattern, clip_bbox,
+         n_workers):
+    logger = logging.getLogger(__name__)
+
+    cadastre_gdf = get_cadastre_gdf(input_filepath,
+                                    unzip_filepattern,
+                                    clip_bbox=clip_bbox,
+                                    n_workers=n_workers)
+
+    # dump the cadastre, e.g., as GeoParquet or GeoPackage (depending on the
+    # extension of `dst_filepath`)
+    cadastre_utils.dump_cadastre(cadastre_gdf, dst_filepath)
+    logger.info("dumped cadastre to %s", dst_filepath)
 
 
 if __name__ == '__main__':
@@ -2,10 +2,10 @@ import logging
 
 import click
 import numpy as np
+import pandas as pd
 import rasterio as rio
-import swiss_uhi_utils as suhi
 
-from urban_es_proposal import settings
+from urban_es_proposal import raster_utils, settings
 
 ORIG_LULC_CODES = [
     0,  # building
@@ -17,30 +17,102 @@ ORIG_LULC_CODES = [
 ]
 
 
+def get_shade_lut_arr(biophysical_table_filepath, lulc_codes):
+    # dense look-up table from LULC codes to the shade values of the
+    # biophysical table, restricted to `lulc_codes` (nan for the others). If
+    # none of `lulc_codes` is in the table, all the codes map to nan
+    biophysical_df = pd.read_csv(biophysical_table_filepath)
+    biophysical_df.columns = biophysical_df.columns.str.lower()
+    shade_ser = biophysical_df.set_index('lucode')['shade']
+    shade_ser = shade_ser[shade_ser.index.isin(lulc_codes)]
+    max_code = shade_ser.index.max() if len(shade_ser) else -1
+    lut_arr = np.full(max_code + 2, np.nan)
+    lut_arr[shade_ser.index] = shade_ser.values
+    return lut_arr
+
+
+def get_min_threshold_arr(lulc_arr, shade_lut_arr):
+    # minimum shade threshold at which each pixel becomes a candidate, i.e.,
+    # its shade, since a pixel is a candidate for any threshold above it (nan
+    # for the pixels that are never candidates). Unknown codes, e.g., nodata,
+    # are mapped to the last (nan) entry of the look-up table
+    lulc_arr = np.asarray(lulc_arr).astype(int)
+    lulc_arr = np.where((lulc_arr >= 0) & (lulc_arr < len(shade_lut_arr)),
+                        lulc_arr, -1)
+    return shade_lut_arr[lulc_arr].astype('float32')
+
+
+def get_candidate_count_ser(min_threshold_arr):
+    # number of candidate pixels for any shade threshold above each of the
+    # (distinct) minimum thresholds
+    thresholds, counts = np.unique(
+        min_threshold_arr[~np.isnan(min_threshold_arr)], return_counts=True)
+    return pd.Series(np.cumsum(counts),
+                     index=pd.Index(thresholds, name='shade_threshold'),
+                     name='num_candidates')
+
+
 @click.command()
 @click.argument('lulc_filepath', type=click.Path(exists=True))
 @click.argument('biophysical_table_filepath', type=click.Path(exists=True))
 @click.argument('dst_filepath', type=click.Path())
 @click.option('--shade-threshold', default=0.75)
 @click.option('--dst-dtype', default='uint8')
+@click.option('--compress',
+              type=click.Choice(raster_utils.COMPRESS_METHODS),
+              default='deflate',
+              required=False)
+@click.option('--min-threshold-filepath',
+              type=click.Path(),
+              required=False,
+              help='Raster of the minimum shade threshold at which each pixel '
+              'becomes a candidate')
+@click.option('--counts-filepath',
+              type=click.Path(),
+              required=False,
+              help='CSV with the number of candidate pixels by threshold')
 def main(lulc_filepath, biophysical_table_filepath, dst_filepath,
-         shade_threshold, dst_dtype):
+         shade_threshold, dst_dtype, compress, min_threshold_filepath,
+         counts_filepath):
     logger = logging.getLogger(__name__)
 
-    sg = suhi.ScenarioGenerator(lulc_filepath,
-                                biophysical_table_filepath,
-                                orig_lulc_codes=ORIG_LULC_CODES)
-    shape = sg.lulc_arr.shape
-    arr = np.zeros(shape, dtype=dst_dtype)
-    arr[np.unravel_index(
-        sg.get_candidate_pixels_df(shade_threshold, 1).index, shape)] = 1
+    # the candidate pixels are those of `ORIG_LULC_CODES` whose shade (from
+    # the biophysical table) is below the threshold (as in swiss_uhi_utils'
+    # `ScenarioGenerator.get_candidate_pixels_df`), so the minimum threshold
+    # of each pixel is computed in a single vectorized pass
+    with rio.open(lulc_filepath) as src:
+        lulc_arr = src.read(1)
+        dst_meta = src.meta.copy()
+    min_threshold_arr = get_min_threshold_arr(
+        lulc_arr, get_shade_lut_arr(biophysical_table_filepath,
+                                    ORIG_LULC_CODES))
+    candidate_count_ser = get_candidate_count_ser(min_threshold_arr)
+    logger.info("computed the minimum shade threshold of %d candidate pixels",
+                candidate_count_ser.max() if len(candidate_count_ser) else 0)
 
-    dst_meta = sg.lulc_meta.copy()
+    # dump the candidate pixels at `shade_threshold`
     dst_meta.update(dtype=dst_dtype)
-    with rio.open(dst_filepath, 'w', **dst_meta) as dst:
-        dst.write(arr, 1)
+    with raster_utils.open_raster(dst_filepath,
+                                  profile='categorical',
+                                  compress=compress,
+                                  **dst_meta) as dst:
+        dst.write((min_threshold_arr < shade_threshold).astype(dst_dtype), 1)
     logger.info("dumped candidate pixel raster to %s", dst_filepath)
 
+    if min_threshold_filepath is not None:
+        dst_meta.update(dtype='float32', nodata=np.nan)
+        with raster_utils.open_raster(min_threshold_filepath,
+                                      profile='continuous',
+                                      compress=compress,
+                                      **dst_meta) as dst:
+            dst.write(min_threshold_arr, 1)
+        logger.info("dumped minimum shade threshold raster to %s",
+                    min_threshold_filepath)
+    if counts_filepath is not None:
+        candidate_count_ser.to_csv(counts_filepath)
+        logger.info("dumped candidate pixel counts by threshold to %s",
+                    counts_filepath)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format=settings.DEFAULT_LOG_FMT)
@@ -1,12 +1,14 @@
+import functools
 import json
 import logging
+import os
 import tempfile
 import warnings
 from os import path
 
 import click
 import dask
-import invest_ucm_calibration as iuc
+import dask.array as da
 import numpy as np
 import pandas as pd
 import pygeoprocessing
@@ -16,76 +18,419 @@ from dask import diagnostics
 from lausanne_greening_scenarios.scenarios import utils as scenario_utils
 from rasterio import transform
 
-from urban_es_proposal import settings
+from urban_es_proposal import (dask_utils, scenario_encoding,
+                               scenario_sampling, scenario_store, settings,
+                               ucm_surrogate, ucm_utils)
+
+# directory for the memory-mapped scenario arrays shared with the workers
+SHARED_MEM_DIR = '/dev/shm' if path.isdir('/dev/shm') else None
+
+CHANGE_RANK_DTYPE = 'int32'
+CHANGE_RANK_VARS = ['lulc_base', 'next_code', 'change_rank']
+CHANGE_RANK_NODATA = -1
+
+# description of the band of the vulnerable population raster used to
+# prioritize the changes
+VULNERABLE_POP_BAND = 'vulnerable'
 
 
 class ScenarioGenerator(scenario_utils.ScenarioGenerator):
-    def generate_lulc_arr(self, change_num, priority_arr=None):
-        if change_num == 0:
-            return self.lulc_arr.copy()
-        elif change_num >= len(self.change_df):
-            pixels_to_change_df = self.change_df
+    def get_change_order(self, priority_arr=None, random_state=None):
+        # positions of the `change_df` rows in the order in which their pixels
+        # are changed, so that the scenario for any change_num is a prefix
+        if priority_arr is not None:
+            # prioritize the pixels according to the raster values
+            return priority_arr.flatten()[
+                self.change_df.index].argsort()[::-1]
         else:
-            if priority_arr is not None:
-                # prioritize the pixels according to the raster values
-                pixels_to_change_df = self.change_df.loc[self.change_df.index[
-                    priority_arr.flatten()[
-                        self.change_df.index].argsort()[::-1]]][:change_num]
-            else:
-                pixels_to_change_df = self.change_df.sample(n=change_num)
+            return np.random.default_rng(random_state).permutation(
+                len(self.change_df))
+
+    def get_change_rank_arr(self, change_order):
+        # rank at which each pixel is changed (-1 for pixels that never are)
+        change_rank_arr = np.full(self.lulc_arr.shape,
+                                  CHANGE_RANK_NODATA,
+                                  dtype=CHANGE_RANK_DTYPE)
+        change_rank_arr.ravel()[self.change_df.index[change_order]] = \
+            np.arange(len(change_order))
+        return change_rank_arr
+
+    def get_next_code_arr(self):
+        next_code_arr = self.lulc_arr.copy()
+        next_code_arr.ravel()[self.change_df.index] = self.change_df[
+            'next_code']
+        return next_code_arr
+
+    def generate_lulc_arr(self,
+                          change_num,
+                          priority_arr=None,
+                          random_state=None,
+                          change_order=None):
+        if change_order is None:
+            change_order = self.get_change_order(priority_arr=priority_arr,
+                                                 random_state=random_state)
+        pixels_to_change_df = self.change_df.iloc[change_order[:change_num]]
         # now build the new LULC array and change the pixels
         new_lulc_arr = self.lulc_arr.copy()
-        for next_code, next_code_df in pixels_to_change_df.groupby(
-                'next_code'):
-            new_lulc_arr.ravel()[next_code_df.index] = next_code
+        new_lulc_arr.ravel()[
+            pixels_to_change_df.index] = pixels_to_change_df['next_code']
 
         return new_lulc_arr
 
+    def generate_change_rank_ds(self,
+                                scenario_runs=None,
+                                priority_arr=None,
+                                random_state=None):
+        # compact representation of the scenarios: the base LULC, the code
+        # that each candidate pixel is changed to and one change rank array
+        # per scenario run, from which any change_num can be materialized
+        dims = ['y', 'x']
+        attrs = dict(nodata=int(self.lulc_meta['nodata']),
+                     pyproj_srs=f'epsg:{self.lulc_meta["crs"].to_epsg()}')
+        if scenario_runs is not None:
+            seeds = np.random.default_rng(random_state).integers(
+                2**32, size=len(scenario_runs))
+            change_rank_da = xr.DataArray(
+                np.array([
+                    self.get_change_rank_arr(
+                        self.get_change_order(priority_arr=priority_arr,
+                                              random_state=seed))
+                    for seed in seeds
+                ]),
+                dims=['scenario_run'] + dims,
+                coords={
+                    'scenario_run': scenario_runs,
+                    **self.coords
+                })
+        else:
+            change_rank_da = xr.DataArray(self.get_change_rank_arr(
+                self.get_change_order(priority_arr=priority_arr,
+                                      random_state=random_state)),
+                                          dims=dims,
+                                          coords=self.coords)
+        change_rank_da.attrs = dict(attrs, nodata=CHANGE_RANK_NODATA)
+
+        return xr.Dataset({
+            'lulc_base':
+            xr.DataArray(self.lulc_arr,
+                         dims=dims,
+                         coords=self.coords,
+                         attrs=attrs),
+            'next_code':
+            xr.DataArray(self.get_next_code_arr(),
+                         dims=dims,
+                         coords=self.coords,
+                         attrs=attrs),
+            'change_rank':
+            change_rank_da
+        })
+
     def generate_scenario_lulc_da(self,
                                   change_nums,
                                   scenario_runs=None,
-                                  priority_arr=None):
+                                  priority_arr=None,
+                                  lazy=False,
+                                  random_state=None):
+        return materialize_scenario_lulc_da(self.generate_change_rank_ds(
+            scenario_runs=scenario_runs,
+            priority_arr=priority_arr,
+            random_state=random_state),
+                                            change_nums,
+                                            lazy=lazy)
 
-        # prepare the xarray data array
-        coords = {'change_num': change_nums, **self.coords}
-        dims = ['change_num']
-        dst_dtype = self.lulc_meta['dtype']
-        if scenario_runs is not None:
-            coords['scenario_run'] = scenario_runs
-            dims += ['scenario_run']
-        dims += ['y', 'x']
-        scenario_lulc_da = xr.DataArray(
-            dims=dims,
-            coords=coords,
-            attrs=dict(nodata=int(self.lulc_meta['nodata']),
-                       pyproj_srs=f'epsg:{self.lulc_meta["crs"].to_epsg()}'))
-
-        def _repeat(arr):
-            if scenario_runs is not None:
-                arr = np.array([arr for scenario_run in scenario_runs],
-                               dtype=dst_dtype)
-            return arr
-
-        # generate the arrays
-        if change_nums[0] == 0:
-            scenario_lulc_da.loc[dict(change_num=0)] = _repeat(self.lulc_arr)
-            change_nums = change_nums[1:]
 
-        if scenario_runs is not None:
-            data = [[
-                self.generate_lulc_arr(change_num, priority_arr=priority_arr)
-                for scenario_run in scenario_runs
-            ] for change_num in change_nums]
+def materialize_scenario_lulc_da(change_rank_ds, change_nums, lazy=False):
+    # get the LULC data array of the scenarios for the given change_nums from
+    # their compact representation (see `generate_change_rank_ds`). Since
+    # pixels that are never changed keep their code in `next_code`, no mask of
+    # valid ranks is needed. If `lazy` is True, the result is backed by dask
+    # with one chunk per scenario, which is only computed when needed
+    lulc_base_da = change_rank_ds['lulc_base']
+    change_rank_da = change_rank_ds['change_rank']
+    change_num_da = xr.DataArray(change_nums,
+                                 dims='change_num',
+                                 coords={'change_num': change_nums})
+    if lazy:
+        change_rank_da = change_rank_da.chunk(
+            {dim: 1
+             for dim in change_rank_da.dims[:-2]})
+        change_num_da = change_num_da.chunk({'change_num': 1})
+    scenario_lulc_da = xr.where(change_rank_da < change_num_da,
+                                change_rank_ds['next_code'], lulc_base_da)
+
+    return scenario_lulc_da.transpose(
+        'change_num', *change_rank_da.dims).astype(
+            lulc_base_da.dtype).assign_attrs(lulc_base_da.attrs)
+
+
+def screen_scenario_runs(change_rank_ds, change_nums, surrogate, num_runs):
+    # keep the `num_runs` scenario runs with the lowest mean temperature (over
+    # all change_nums) as predicted by the UCM surrogate, so that only the
+    # most promising ones are simulated with the actual UCM
+    scenario_lulc_da = materialize_scenario_lulc_da(change_rank_ds,
+                                                    change_nums,
+                                                    lazy=True)
+    pred_ser = pd.Series(
+        [
+            np.nanmean(
+                surrogate.predict_t_arrs(
+                    scenario_lulc_da.sel(scenario_run=scenario_run).values))
+            for scenario_run in change_rank_ds['scenario_run'].values
+        ],
+        index=change_rank_ds['scenario_run'].values)
+    logging.getLogger(__name__).info(
+        "screened %d scenario runs with the UCM surrogate, predicted mean "
+        "temperatures: %s", len(pred_ser), pred_ser.to_dict())
+
+    return change_rank_ds.sel(
+        scenario_run=np.sort(pred_ser.nsmallest(num_runs).index.values))
+
+
+def get_change_rank_ds(scenario_generator,
+                       change_nums,
+                       store_filepath=None,
+                       resume=False,
+                       random_state=None,
+                       surrogate_filepath=None,
+                       screen_num_runs=1,
+                       **generate_kws):
+    if resume and store_filepath is not None and path.exists(store_filepath):
+        # reuse the scenarios of the interrupted run
+        return xr.open_zarr(store_filepath)[CHANGE_RANK_VARS].load()
+
+    change_rank_ds = scenario_generator.generate_change_rank_ds(
+        random_state=random_state, **generate_kws)
+    if surrogate_filepath is not None and 'scenario_run' in change_rank_ds:
+        change_rank_ds = screen_scenario_runs(
+            change_rank_ds, change_nums,
+            ucm_surrogate.UCMSurrogate.load(surrogate_filepath),
+            screen_num_runs)
+
+    return change_rank_ds
+
+
+def _t_from_shared_lulc(t_from_lulc, lulc_mmap_kws, t_mmap_kws, i):
+    # read the i-th LULC array and write its temperature in place, so that
+    # workers only receive an index into the shared (memory-mapped) arrays
+    t_mmap = np.memmap(mode='r+', **t_mmap_kws)
+    t_mmap[i] = t_from_lulc(np.memmap(mode='r', **lulc_mmap_kws)[i])
+    t_mmap.flush()
+
+
+def simulate_shared(t_from_lulc, lulc_arrs, t_arrs):
+    # simulate each LULC array with dask, using memory-mapped files (in shared
+    # memory if available) rather than pickling the arrays to/from workers
+    shape = lulc_arrs.shape
+    with tempfile.TemporaryDirectory(dir=SHARED_MEM_DIR) as tmp_dir:
+        lulc_mmap_kws = dict(filename=path.join(tmp_dir, 'lulc.dat'),
+                             dtype=lulc_arrs.dtype,
+                             shape=shape)
+        lulc_mmap = np.memmap(mode='w+', **lulc_mmap_kws)
+        lulc_mmap[:] = lulc_arrs
+        lulc_mmap.flush()
+        del lulc_mmap
+        t_mmap_kws = dict(filename=path.join(tmp_dir, 'T.dat'),
+                          dtype=t_arrs.dtype,
+                          shape=t_arrs.shape)
+        np.memmap(mode='w+', **t_mmap_kws).flush()
+
+        with diagnostics.ProgressBar():
+            dask.compute(*[
+                dask.delayed(_t_from_shared_lulc)(t_from_lulc, lulc_mmap_kws,
+                                                  t_mmap_kws, i)
+                for i in range(shape[0])
+            ],
+                         scheduler=dask_utils.get_scheduler())
+        t_arrs[:] = np.memmap(mode='r', **t_mmap_kws)
+
+
+def simulate_pickled(t_from_lulc, lulc_arrs, t_arrs):
+    # simulate each LULC array with dask, sending the arrays to the workers,
+    # e.g., when these do not share memory with this process
+    with diagnostics.ProgressBar():
+        t_arrs[:] = dask.compute(
+            *[dask.delayed(t_from_lulc)(lulc_arr) for lulc_arr in lulc_arrs],
+            scheduler=dask_utils.get_scheduler())
+
+
+def compute_t_arrs(t_from_lulc,
+                   lulc_arrs,
+                   dst_t_dtype,
+                   cache=None,
+                   shared_mem=True,
+                   t_shape=None):
+    # serve the cached scenarios and simulate the rest, each distinct LULC
+    # array (e.g., the baseline of each scenario run) only once. The
+    # temperature of each scenario has the shape of its LULC array unless
+    # `t_shape` is provided
+    get_key = ucm_utils.get_lulc_digest if cache is None else cache.get_key
+    keys = [get_key(lulc_arr) for lulc_arr in lulc_arrs]
+    # position of the first LULC array of each key
+    key_index = {}
+    for i, key in enumerate(keys):
+        key_index.setdefault(key, i)
+
+    if t_shape is None:
+        t_shape = lulc_arrs.shape[1:]
+    t_arrs = np.empty((len(lulc_arrs), ) + tuple(t_shape), dtype=dst_t_dtype)
+    simulate_index = []
+    for key, i in key_index.items():
+        t_arr = None if cache is None else cache.get(key)
+        if t_arr is None:
+            simulate_index.append(i)
+        else:
+            t_arrs[i] = t_arr
+
+    if simulate_index:
+        simulated_t_arrs = t_arrs[simulate_index]
+        simulate = simulate_shared if shared_mem else simulate_pickled
+        simulate(t_from_lulc, lulc_arrs[simulate_index], simulated_t_arrs)
+        t_arrs[simulate_index] = simulated_t_arrs
+        if cache is not None:
+            for i in simulate_index:
+                cache.set(keys[i], t_arrs[i])
+
+    # fill the repeated LULC arrays
+    for i, key in enumerate(keys):
+        t_arrs[i] = t_arrs[key_index[key]]
+
+    return t_arrs
+
+
+def get_rio_meta(scenario_lulc_da):
+    x = scenario_lulc_da['x'].values
+    y = scenario_lulc_da['y'].values
+    west = x[0]
+    north = y[0]
+    # TODO: does the method to get the transform work for all grids, i.e.,
+    # regardless of whether the origin is in the upper left or lower left?
+    return dict(driver='GTiff',
+                dtype=scenario_lulc_da.dtype,
+                nodata=scenario_lulc_da.attrs['nodata'],
+                width=len(x),
+                height=len(y),
+                count=1,
+                crs=scenario_lulc_da.attrs['pyproj_srs'],
+                transform=transform.from_origin(west, north, x[1] - west,
+                                                north - y[1]))
+
+
+def cached_t_from_lulc(t_from_lulc, lulc_arr, cache=None):
+    if cache is None:
+        return t_from_lulc(lulc_arr)
+    key = cache.get_key(lulc_arr)
+    t_arr = cache.get(key)
+    if t_arr is None:
+        t_arr = t_from_lulc(lulc_arr)
+        cache.set(key, t_arr)
+    return t_arr
+
+
+def lazy_t_data(t_from_lulc,
+                lulc_data,
+                dst_t_dtype,
+                cache=None,
+                repeat_baseline=False,
+                t_shape=None):
+    # lazily simulate the temperature of each (single-scenario) LULC chunk so
+    # that scenarios are only materialized when the output is computed. If
+    # `repeat_baseline` is True, the first change_num (i.e., 0) is simulated
+    # only for the first scenario run and repeated for the others
+    ndim = lulc_data.ndim
+    shape = lulc_data.shape[-2:]
+    if t_shape is None:
+        t_shape = shape
+    lulc_blocks = lulc_data.rechunk((1, ) * (ndim - 2) + shape).to_delayed()
+    lulc_blocks = lulc_blocks[(Ellipsis, 0, 0)]
+
+    def _t_block(lulc_block):
+        return cached_t_from_lulc(t_from_lulc,
+                                  lulc_block.reshape(shape),
+                                  cache=cache).astype(dst_t_dtype)
+
+    t_block = dask.delayed(_t_block, pure=True)
+    t_blocks = np.empty(lulc_blocks.shape, dtype=object)
+    for index in np.ndindex(lulc_blocks.shape):
+        if repeat_baseline and ndim > 3 and index[0] == 0 and index[1] > 0:
+            t_blocks[index] = t_blocks[0, 0]
         else:
-            data = [
-                self.generate_lulc_arr(change_num, priority_arr=priority_arr)
-                for change_num in change_nums
-            ]
-        scenario_lulc_da.loc[dict(change_num=change_nums)] = np.array(
-            data, dtype=dst_dtype)
+            t_blocks[index] = da.from_delayed(t_block(lulc_blocks[index]),
+                                              shape=t_shape,
+                                              dtype=dst_t_dtype)
+    return da.stack(t_blocks.ravel().tolist()).reshape(lulc_data.shape[:-2] +
+                                                       tuple(t_shape))
+
+
+def get_t_from_lulc(rio_meta,
+                    biophysical_table_filepath,
+                    ref_et_raster_filepath,
+                    t_ref,
+                    uhi_max,
+                    ucm_params,
+                    cc_method='factors',
+                    cache_dir=None,
+                    cache_max_size=None,
+                    param_sets=None):
+    # curry the fixed arguments so that each (worker) process reuses its own
+    # warm UCM worker across scenarios. In ensemble mode, i.e., if
+    # `param_sets` is provided, the `t_ref`, `uhi_max`, `ucm_params` and
+    # `cc_method` of each parameter set are used instead
+    ucm_worker_kws = dict(
+        rio_meta=rio_meta,
+        biophysical_table_filepath=biophysical_table_filepath,
+        ref_et_raster_filepath=ref_et_raster_filepath)
+    if param_sets is None:
+        t_from_lulc = functools.partial(ucm_utils.predict_t_arr,
+                                        t_ref=t_ref,
+                                        uhi_max=uhi_max,
+                                        ucm_params=ucm_params,
+                                        cc_method=cc_method,
+                                        **ucm_worker_kws)
+    else:
+        t_from_lulc = functools.partial(ucm_utils.predict_t_arrs,
+                                        param_sets=param_sets,
+                                        **ucm_worker_kws)
 
-        # return the data array
-        return scenario_lulc_da.astype(dst_dtype)
+    if cache_dir is not None:
+        if param_sets is None:
+            ucm_token = ucm_utils.get_ucm_token(
+                rio_meta,
+                biophysical_table_filepath,
+                ref_et_raster_filepath,
+                t_ref,
+                uhi_max,
+                ucm_params,
+                cc_method)
+        else:
+            ucm_token = ucm_utils.get_ensemble_token(
+                rio_meta,
+                biophysical_table_filepath,
+                ref_et_raster_filepath,
+                param_sets)
+        cache = ucm_utils.TCache(cache_dir,
+                                 ucm_token,
+                                 max_size=cache_max_size)
+    else:
+        cache = None
+
+    return t_from_lulc, cache
+
+
+def get_t_layout(scenario_lulc_da, param_sets=None):
+    # shape of the temperature array of each scenario, and dims, coords and
+    # attrs of the temperature data array, which in ensemble mode has a
+    # `param_set` dim (before the grid dims)
+    t_shape = scenario_lulc_da.shape[-2:]
+    t_dims = scenario_lulc_da.dims
+    t_coords = {dim: scenario_lulc_da.coords[dim] for dim in t_dims}
+    t_attrs = dict(nodata=np.nan,
+                   pyproj_srs=scenario_lulc_da.attrs['pyproj_srs'])
+    if param_sets is not None:
+        t_shape = (len(param_sets), ) + t_shape
+        t_dims = t_dims[:-2] + ('param_set', ) + t_dims[-2:]
+        t_coords['param_set'] = np.arange(len(param_sets))
+        t_attrs['param_sets'] = json.dumps(param_sets)
+    return t_shape, t_dims, t_coords, t_attrs
 
 
 def simulate_scenario_t_da(scenario_lulc_da,
@@ -96,87 +441,321 @@ def simulate_scenario_t_da(scenario_lulc_da,
                            ucm_params,
                            dst_t_dtype='float32',
                            rio_meta=None,
-                           cc_method='factors'):
+                           cc_method='factors',
+                           cache_dir=None,
+                           cache_max_size=None,
+                           shared_mem=True,
+                           param_sets=None):
     if rio_meta is None:
-        x = scenario_lulc_da['x'].values
-        y = scenario_lulc_da['y'].values
-        west = x[0]
-        north = y[0]
-        # TODO: does the method to get the transform work for all grids, i.e.,
-        # regardless of whether the origin is in the upper left or lower left?
-        rio_meta = dict(driver='GTiff',
-                        dtype=scenario_lulc_da.dtype,
-                        nodata=scenario_lulc_da.attrs['nodata'],
-                        width=len(x),
-                        height=len(y),
-                        count=1,
-                        crs=scenario_lulc_da.attrs['pyproj_srs'],
-                        transform=transform.from_origin(
-                            west, north, x[1] - west, north - y[1]))
-
-    # define the function here so that the fixed arguments are curried
-    def _t_from_lulc(lulc_arr):
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            lulc_raster_filepath = path.join(tmp_dir, 'lulc.tif')
-            with rio.open(lulc_raster_filepath, 'w', **rio_meta) as dst:
-                dst.write(lulc_arr, 1)
-            ucm_wrapper = iuc.UCMWrapper(lulc_raster_filepath,
-                                         biophysical_table_filepath,
-                                         cc_method,
-                                         ref_et_raster_filepath,
-                                         t_ref,
-                                         uhi_max,
-                                         extra_ucm_args=ucm_params,
-                                         workspace_dir=tmp_dir)
-            return ucm_wrapper.predict_t_arr(0)
-
-    scenario_t_da = xr.DataArray(
-        dims=scenario_lulc_da.dims,
-        coords=scenario_lulc_da.coords,
-        attrs=dict(nodata=np.nan,
-                   pyproj_srs=scenario_lulc_da.attrs['pyproj_srs']))
-
-    change_nums = scenario_t_da['change_num'].values
-    scenario_runs = scenario_t_da.coords.get('scenario_run', None)
+        rio_meta = get_rio_meta(scenario_lulc_da)
 
-    def _simulate_and_repeat(change_num):
-        # simulate once and repeat it for all scenario runs
-        lulc_da = scenario_lulc_da.sel(change_num=change_num)
-        if scenario_runs is not None:
-            t_arr = _t_from_lulc(lulc_da.isel(scenario_run=0))
-            t_arr = np.array(
-                [t_arr for scenario_run in scenario_t_da['scenario_run']],
-                dtype=dst_t_dtype)
-        else:
-            t_arr = _t_from_lulc(lulc_da)
-        return t_arr
+    _t_from_lulc, cache = get_t_from_lulc(
+        rio_meta,
+        biophysical_table_filepath,
+        ref_et_raster_filepath,
+        t_ref,
+        uhi_max,
+        ucm_params,
+        cc_method=cc_method,
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+        param_sets=param_sets)
 
-    if change_nums[0] == 0:
-        scenario_t_da.loc[dict(change_num=0)] = _simulate_and_repeat(0)
-        change_nums = change_nums[1:]
+    change_nums = scenario_lulc_da['change_num'].values
+    if isinstance(scenario_lulc_da.data, da.Array):
+        t_shape, t_dims, t_coords, t_attrs = get_t_layout(
+            scenario_lulc_da, param_sets=param_sets)
+        scenario_t_da = xr.DataArray(lazy_t_data(
+            _t_from_lulc,
+            scenario_lulc_da.data,
+            dst_t_dtype,
+            cache=cache,
+            repeat_baseline=change_nums[0] == 0,
+            t_shape=t_shape),
+                                     dims=t_dims,
+                                     coords=t_coords,
+                                     attrs=t_attrs)
+        return scenario_t_da.where(scenario_t_da > -273.15, np.nan)
 
     scenario_dims = scenario_lulc_da.dims[:-2]
-    stacked_da = scenario_lulc_da.sel(change_num=change_nums).stack(
-        scenario=scenario_dims).transpose('scenario', 'y', 'x')
-    with diagnostics.ProgressBar():
-        scenario_t_da.loc[dict(change_num=change_nums)] = xr.DataArray(
-            np.array(
-                dask.compute(*[
-                    dask.delayed(_t_from_lulc)(_scenario_lulc_da)
-                    for _scenario_lulc_da in stacked_da
-                ],
-                             scheduler='processes')).astype(dst_t_dtype),
-            dims=stacked_da.dims,
-            coords={dim: stacked_da.coords[dim]
-                    for dim in stacked_da.dims},
-            attrs=dict(dtype=dst_t_dtype)).unstack(dim='scenario').transpose(
-                *scenario_dims, 'y', 'x')
+    stacked_da = scenario_lulc_da.stack(scenario=scenario_dims).transpose(
+        'scenario', 'y', 'x')
+    t_shape, t_dims, t_coords, t_attrs = get_t_layout(stacked_da,
+                                                      param_sets=param_sets)
+    scenario_t_da = xr.DataArray(
+        compute_t_arrs(_t_from_lulc,
+                       stacked_da.values,
+                       dst_t_dtype,
+                       cache=cache,
+                       shared_mem=shared_mem,
+                       t_shape=t_shape),
+        dims=t_dims,
+        coords=t_coords).unstack(dim='scenario').transpose(
+            *scenario_dims, *t_dims[1:]).assign_attrs(t_attrs)
     # replace nodata values - UCM/InVEST uses minus infinity, so we can use
     # temperatures lower than the absolute zero as a reference threshold which
     # (physically) makes sense
     return scenario_t_da.where(scenario_t_da > -273.15, np.nan)
 
 
+def simulate_adaptive_scenario_t_da(change_rank_ds,
+                                    biophysical_table_filepath,
+                                    ref_et_raster_filepath,
+                                    t_ref,
+                                    uhi_max,
+                                    ucm_params,
+                                    change_num_min=0,
+                                    change_num_max=100000,
+                                    change_num_step=5000,
+                                    lazy=False,
+                                    tol=0.01,
+                                    max_ucm_runs=None,
+                                    init_num=None,
+                                    **simulate_kws):
+    # simulate the temperatures for adaptively sampled change_nums (see
+    # `scenario_sampling.sample_scenario_t_da`) rather than a uniform grid
+    def _simulate_t_da(change_nums):
+        return simulate_scenario_t_da(
+            materialize_scenario_lulc_da(change_rank_ds,
+                                         change_nums,
+                                         lazy=lazy),
+            biophysical_table_filepath, ref_et_raster_filepath, t_ref,
+            uhi_max, ucm_params, **simulate_kws).compute()
+
+    if init_num is None:
+        init_num = scenario_sampling.ADAPTIVE_INIT_NUM
+
+    return scenario_sampling.sample_scenario_t_da(
+        _simulate_t_da,
+        change_num_min,
+        change_num_max,
+        change_num_step,
+        # each scenario is simulated once per parameter set (if any)
+        num_runs=change_rank_ds.sizes.get('scenario_run', 1) *
+        len(simulate_kws.get('param_sets') or [None]),
+        tol=tol,
+        max_ucm_runs=max_ucm_runs,
+        init_num=init_num)
+
+
+def simulate_scenario_ds(change_rank_ds,
+                         change_nums,
+                         biophysical_table_filepath,
+                         ref_et_raster_filepath,
+                         t_ref,
+                         uhi_max,
+                         ucm_params,
+                         lazy=False,
+                         compact_lulc=False,
+                         adaptive_kws=None,
+                         **simulate_kws):
+    # simulate the scenario dataset for `change_nums`, or for adaptively
+    # sampled change_nums if `adaptive_kws` (the keyword arguments of
+    # `simulate_adaptive_scenario_t_da`) are provided
+    simulate_args = (biophysical_table_filepath, ref_et_raster_filepath,
+                     t_ref, uhi_max, ucm_params)
+    if adaptive_kws is not None:
+        scenario_t_da = simulate_adaptive_scenario_t_da(change_rank_ds,
+                                                        *simulate_args,
+                                                        lazy=lazy,
+                                                        **adaptive_kws,
+                                                        **simulate_kws)
+        change_nums = scenario_t_da['change_num'].values
+        scenario_lulc_da = materialize_scenario_lulc_da(change_rank_ds,
+                                                        change_nums,
+                                                        lazy=lazy)
+    else:
+        scenario_lulc_da = materialize_scenario_lulc_da(change_rank_ds,
+                                                        change_nums,
+                                                        lazy=lazy)
+        scenario_t_da = simulate_scenario_t_da(scenario_lulc_da,
+                                               *simulate_args,
+                                               **simulate_kws)
+    if compact_lulc:
+        # store the change ranks rather than the LULC of each scenario, which
+        # can be recovered with `materialize_scenario_lulc_da`
+        return change_rank_ds.assign(T=scenario_t_da)
+    return xr.Dataset({'lulc': scenario_lulc_da, 'T': scenario_t_da})
+
+
+def make_scenario_store(store_filepath,
+                        change_rank_ds,
+                        change_nums,
+                        dst_t_dtype='float32',
+                        compact_lulc=False,
+                        resume=False,
+                        param_sets=None):
+    # the store always keeps the compact representation of the scenarios so
+    # that resumed runs simulate the very same (e.g., random) scenarios
+    scenario_lulc_da = materialize_scenario_lulc_da(change_rank_ds,
+                                                    change_nums,
+                                                    lazy=True)
+    t_shape, t_dims, t_coords, t_attrs = get_t_layout(scenario_lulc_da,
+                                                      param_sets=param_sets)
+    template_ds = change_rank_ds.assign(T=xr.DataArray(
+        da.full(scenario_lulc_da.shape[:-2] + t_shape,
+                np.nan,
+                chunks=scenario_lulc_da.chunks[:-2] + t_shape,
+                dtype=dst_t_dtype),
+        dims=t_dims,
+        coords=t_coords,
+        attrs=t_attrs))
+    if not compact_lulc:
+        template_ds['lulc'] = scenario_lulc_da
+
+    return scenario_store.ScenarioStore(store_filepath,
+                                        template_ds,
+                                        resume=resume)
+
+
+def simulate_scenario_store(store,
+                            scenario_lulc_da,
+                            biophysical_table_filepath,
+                            ref_et_raster_filepath,
+                            t_ref,
+                            uhi_max,
+                            ucm_params,
+                            dst_t_dtype='float32',
+                            rio_meta=None,
+                            cc_method='factors',
+                            cache_dir=None,
+                            cache_max_size=None,
+                            shared_mem=True,
+                            batch_size=None,
+                            param_sets=None):
+    # simulate the scenarios that are not in the store yet in batches, and
+    # write each one as soon as its batch is completed so that the memory
+    # footprint is bounded by the batch size (by default, one scenario per
+    # worker). Ideally, `scenario_lulc_da` should be lazy
+    logger = logging.getLogger(__name__)
+    if rio_meta is None:
+        rio_meta = get_rio_meta(scenario_lulc_da)
+    t_from_lulc, cache = get_t_from_lulc(
+        rio_meta,
+        biophysical_table_filepath,
+        ref_et_raster_filepath,
+        t_ref,
+        uhi_max,
+        ucm_params,
+        cc_method=cc_method,
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+        param_sets=param_sets)
+    if batch_size is None:
+        batch_size = dask.config.get('num_workers', None) or os.cpu_count()
+
+    pending = store.get_pending()
+    logger.info("%d scenarios already in %s, %d pending",
+                len(store.completed), store.store_filepath, len(pending))
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        lulc_arrs = np.array(
+            [scenario_lulc_da[index].values for index in batch])
+        t_arrs = compute_t_arrs(
+            t_from_lulc,
+            lulc_arrs,
+            dst_t_dtype,
+            cache=cache,
+            shared_mem=shared_mem,
+            t_shape=None if param_sets is None else
+            (len(param_sets), ) + lulc_arrs.shape[1:])
+        # replace nodata values (see `simulate_scenario_t_da`)
+        t_arrs[~(t_arrs > -273.15)] = np.nan
+        for index, lulc_arr, t_arr in zip(batch, lulc_arrs, t_arrs):
+            arr_dict = {'T': t_arr}
+            if 'lulc' in store.variables:
+                arr_dict['lulc'] = lulc_arr
+            store.write(index, arr_dict)
+        logger.info("dumped %d/%d pending scenarios to %s",
+                    start + len(batch), len(pending), store.store_filepath)
+
+
+def get_param_sets(param_sets_filepath,
+                   station_t_df,
+                   ucm_params,
+                   cc_method='factors'):
+    # parameter sets of the ensemble mode from a JSON list where each item
+    # may override the calibrated `ucm_params` (merged with them), the
+    # `cc_method`, the `date` (column of the station temperature data frame)
+    # from which the reference temperature and UHI magnitude are computed, or
+    # directly the `t_ref` and `uhi_max`
+    if param_sets_filepath is None:
+        return None
+    with open(param_sets_filepath) as src:
+        param_set_specs = json.load(src)
+
+    param_sets = []
+    for param_set_spec in param_set_specs:
+        station_t_ser = station_t_df[param_set_spec.get(
+            'date', station_t_df.columns[0])]
+        param_sets.append(
+            dict(t_ref=float(
+                param_set_spec.get('t_ref', station_t_ser.min())),
+                 uhi_max=float(
+                     param_set_spec.get(
+                         'uhi_max',
+                         station_t_ser.max() - station_t_ser.min())),
+                 ucm_params=dict(ucm_params,
+                                 **param_set_spec.get('ucm_params', {})),
+                 cc_method=param_set_spec.get('cc_method', cc_method)))
+
+    return param_sets
+
+
+def read_vulnerable_pop_arr(vulnerable_pop_filepath):
+    # read the band of the vulnerable population by its description (the
+    # raster can have other population groups), or the first band of rasters
+    # without band descriptions
+    with rio.open(vulnerable_pop_filepath) as src:
+        if VULNERABLE_POP_BAND in src.descriptions:
+            return src.read(src.descriptions.index(VULNERABLE_POP_BAND) + 1)
+        if any(src.descriptions):
+            raise ValueError(f"{vulnerable_pop_filepath} has no band "
+                             f"described as {VULNERABLE_POP_BAND}")
+        return src.read(1)
+
+
+def log_t_cache_stats(cache_dir):
+    # the hits, misses and evictions of the temperature caches of this run,
+    # including those of the worker processes
+    if cache_dir is not None:
+        logging.getLogger(__name__).info(
+            "temperature cache at %s: %s", cache_dir,
+            ucm_utils.get_t_cache_stats(cache_dir, clear=True))
+
+
+def dump_scenario_ds(scenario_ds,
+                     dst_filepath,
+                     compression='zlib',
+                     complevel=4,
+                     quantize_t=False,
+                     dedup_runs=False):
+    if dedup_runs:
+        scenario_ds = scenario_encoding.dedup_scenario_runs(scenario_ds)
+    if compression == 'none':
+        compression = None
+    with diagnostics.ProgressBar():
+        scenario_ds.to_netcdf(dst_filepath,
+                              encoding=scenario_encoding.get_encoding(
+                                  scenario_ds,
+                                  compression=compression,
+                                  complevel=complevel,
+                                  quantize_t=quantize_t))
+
+
+def check_simulate_options(store_filepath, adaptive, lazy, dedup_runs):
+    if adaptive and store_filepath is not None:
+        raise click.UsageError(
+            "The adaptive sampling cannot be used with a scenario store, "
+            "whose change_nums must be known in advance")
+    if dedup_runs and lazy and store_filepath is None:
+        # deduplicating compares the temperatures of the scenario runs before
+        # dumping them, which would simulate the lazy scenarios twice
+        raise click.UsageError(
+            "--dedup-runs cannot be used with --lazy (unless the scenarios "
+            "are simulated to a scenario store)")
+
+
 @click.command()
 @click.argument('lulc_raster_filepath', type=click.Path(exists=True))
 @click.argument('biophysical_table_filepath', type=click.Path(exists=True))
@@ -191,11 +770,105 @@ def simulate_scenario_t_da(scenario_lulc_da,
               type=click.Path(exists=True),
               required=False)
 @click.option('--num-scenario-runs', type=int, required=False)
+@click.option('--cache-dir', type=click.Path(), required=False)
+@click.option('--cache-max-size',
+              type=int,
+              required=False,
+              help='Maximum size of the temperature cache (in MB)')
+@click.option('--lazy/--no-lazy', default=False, required=False)
+@click.option('--random-state', type=int, required=False)
+@click.option('--compact-lulc/--no-compact-lulc',
+              default=False,
+              required=False)
+@click.option('--scheduler',
+              type=click.Choice(dask_utils.SCHEDULERS),
+              default='processes',
+              required=False)
+@click.option('--n-workers', type=int, required=False)
+@click.option('--threads-per-worker',
+              type=int,
+              required=False,
+              help='Only for the distributed scheduler')
+@click.option('--memory-limit',
+              required=False,
+              help='Memory limit per worker, e.g., "4GB" (only for the '
+              'distributed scheduler)')
+@click.option('--scheduler-address',
+              required=False,
+              help='Address of a running distributed scheduler')
+@click.option('--store-filepath',
+              type=click.Path(),
+              required=False,
+              help='Zarr store where each scenario is dumped as soon as it '
+              'is simulated (implied if `dst_filepath` ends with ".zarr")')
+@click.option('--resume/--no-resume',
+              default=False,
+              required=False,
+              help='Skip the scenarios that are already in the store')
+@click.option('--batch-size',
+              type=int,
+              required=False,
+              help='Number of scenarios simulated between store dumps')
+@click.option('--compression',
+              type=click.Choice(['zlib', 'zstd', 'none']),
+              default='zlib',
+              required=False)
+@click.option('--complevel', type=int, default=4, required=False)
+@click.option('--quantize-t/--no-quantize-t',
+              default=False,
+              required=False,
+              help='Store temperatures as 16-bit integers (0.01 °C)')
+@click.option('--dedup-runs/--no-dedup-runs',
+              default=False,
+              required=False,
+              help='Store temperatures that are identical for all scenario '
+              'runs only once (read the dataset with `open_scenario_ds`)')
+@click.option('--adaptive/--no-adaptive',
+              default=False,
+              required=False,
+              help='Refine the change_nums where the response curve bends or '
+              'the scenario runs disagree rather than using a uniform grid')
+@click.option('--adaptive-tol',
+              type=float,
+              default=0.01,
+              required=False,
+              help='Tolerance (in °C) of the adaptive sampling')
+@click.option('--adaptive-init-num',
+              type=int,
+              required=False,
+              help='Number of change_nums of the initial grid of the '
+              'adaptive sampling')
+@click.option('--max-ucm-runs',
+              type=int,
+              required=False,
+              help='Budget of UCM runs of the adaptive sampling')
+@click.option('--surrogate-filepath',
+              type=click.Path(exists=True),
+              required=False,
+              help='UCM surrogate (see `make_ucm_surrogate.py`) used to '
+              'screen the scenario runs')
+@click.option('--screen-num-runs',
+              type=int,
+              default=1,
+              required=False,
+              help='Number of the `--num-scenario-runs` candidate runs kept '
+              'after the surrogate screening')
+@click.option('--param-sets-filepath',
+              type=click.Path(exists=True),
+              required=False,
+              help='JSON list of UCM parameter sets (overriding `ucm_params`,'
+              ' `cc_method`, `date`, `t_ref` and/or `uhi_max`) to simulate '
+              'each scenario with, along an extra `param_set` dim')
 def main(lulc_raster_filepath, biophysical_table_filepath,
          ref_et_raster_filepath, station_t_filepath,
          calibrated_params_filepath, dst_filepath, change_num_step,
          change_num_min, change_num_max, vulnerable_pop_filepath,
-         num_scenario_runs):
+         num_scenario_runs, cache_dir, cache_max_size,
+         lazy, random_state, compact_lulc, scheduler, n_workers,
+         threads_per_worker, memory_limit, scheduler_address, store_filepath,
+         resume, batch_size, compression, complevel, quantize_t, dedup_runs,
+         adaptive, adaptive_tol, adaptive_init_num, max_ucm_runs,
+         surrogate_filepath, screen_num_runs, param_sets_filepath):
     logger = logging.getLogger(__name__)
     # disable InVEST's logging
     for module in ('natcap.invest.urban_cooling_model', 'natcap.invest.utils',
@@ -236,31 +909,95 @@ def main(lulc_raster_filepath, biophysical_table_filepath,
     with open(calibrated_params_filepath) as src:
         ucm_params = json.load(src)
 
+    # 1.3. get the parameter sets of the ensemble (if any)
+    param_sets = get_param_sets(param_sets_filepath, station_t_df, ucm_params)
+
+    if cache_max_size is not None:
+        cache_max_size *= 2**20
+
     # 2. generate scenarios
     change_nums = np.arange(change_num_min, change_num_max + change_num_step,
                             change_num_step)
+    if store_filepath is None and dst_filepath.endswith('.zarr'):
+        store_filepath = dst_filepath
+    check_simulate_options(store_filepath, adaptive, lazy, dedup_runs)
     sg = ScenarioGenerator(lulc_raster_filepath, biophysical_table_filepath)
     kws = {}
     if vulnerable_pop_filepath:
-        with rio.open(vulnerable_pop_filepath) as src:
-            kws['priority_arr'] = src.read(1)
+        kws['priority_arr'] = read_vulnerable_pop_arr(vulnerable_pop_filepath)
     else:
         kws['scenario_runs'] = np.arange(num_scenario_runs)
 
-    scenario_lulc_da = sg.generate_scenario_lulc_da(change_nums, **kws)
-    logger.info("simulated LULC raster for %d scenarios",
-                np.prod(scenario_lulc_da.shape[:-2]))
-
-    scenario_t_da = simulate_scenario_t_da(scenario_lulc_da,
-                                           biophysical_table_filepath,
-                                           ref_et_raster_filepath, t_ref,
-                                           uhi_max, ucm_params)
-    logger.info("simulated temperature for each scenario")
+    change_rank_ds = get_change_rank_ds(sg,
+                                        change_nums,
+                                        store_filepath=store_filepath,
+                                        resume=resume,
+                                        random_state=random_state,
+                                        surrogate_filepath=surrogate_filepath,
+                                        screen_num_runs=screen_num_runs,
+                                        **kws)
+    # 3. simulate the temperatures and dump the dataset (the latter also
+    #    computes the scenarios in lazy mode, chunk by chunk)
+    simulate_args = (biophysical_table_filepath, ref_et_raster_filepath,
+                     t_ref, uhi_max, ucm_params)
+    simulate_kws = dict(
+        cache_dir=cache_dir,
+        cache_max_size=cache_max_size,
+        # remote workers do not share memory with this process
+        shared_mem=scheduler_address is None,
+        param_sets=param_sets)
+    with dask_utils.scheduler_context(scheduler,
+                                      n_workers=n_workers,
+                                      threads_per_worker=threads_per_worker,
+                                      memory_limit=memory_limit,
+                                      address=scheduler_address):
+        if store_filepath is not None:
+            # the checkpointed mode only materializes the scenarios of each
+            # batch
+            store = make_scenario_store(store_filepath,
+                                        change_rank_ds,
+                                        change_nums,
+                                        compact_lulc=compact_lulc,
+                                        resume=resume,
+                                        param_sets=param_sets)
+            simulate_scenario_store(store,
+                                    materialize_scenario_lulc_da(
+                                        change_rank_ds, change_nums,
+                                        lazy=True),
+                                    *simulate_args,
+                                    batch_size=batch_size,
+                                    **simulate_kws)
+            log_t_cache_stats(cache_dir)
+            if store_filepath == dst_filepath:
+                return
+            scenario_ds = store.open_dataset()
+            if not compact_lulc:
+                scenario_ds = scenario_ds.drop_vars(CHANGE_RANK_VARS)
+        else:
+            scenario_ds = simulate_scenario_ds(
+                change_rank_ds,
+                change_nums,
+                *simulate_args,
+                lazy=lazy,
+                compact_lulc=compact_lulc,
+                adaptive_kws=dict(change_num_min=change_num_min,
+                                  change_num_max=change_num_max,
+                                  change_num_step=change_num_step,
+                                  tol=adaptive_tol,
+                                  max_ucm_runs=max_ucm_runs,
+                                  init_num=adaptive_init_num)
+                if adaptive else None,
+                **simulate_kws)
+        logger.info("simulated temperature for each scenario")
 
-    xr.Dataset({
-        'lulc': scenario_lulc_da,
-        'T': scenario_t_da
-    }).to_netcdf(dst_filepath)
+        dump_scenario_ds(scenario_ds,
+                         dst_filepath,
+                         compression=compression,
+                         complevel=complevel,
+                         quantize_t=quantize_t,
+                         dedup_runs=dedup_runs)
+        if store_filepath is None:
+            log_t_cache_stats(cache_dir)
     logger.info("dumped scenario dataset to %s", dst_filepath)
 
 
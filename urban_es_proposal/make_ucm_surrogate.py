@@ -0,0 +1,143 @@
+import json
+import logging
+
+import click
+import numpy as np
+
+from urban_es_proposal import (make_scenario_ds, scenario_encoding, settings,
+                               ucm_surrogate, ucm_utils)
+
+
+def get_scenario_arrs(scenario_ds, param_set=0):
+    # stacked (LULC, T) arrays of all the scenarios of a dataset, either with
+    # the LULC of each scenario or its compact representation, and the
+    # scenario run of each scenario (zero if the dataset has a single run).
+    # For ensemble datasets, only the temperatures of `param_set` are used
+    if 'param_set' in scenario_ds.dims:
+        scenario_ds = scenario_ds.isel(param_set=param_set)
+    if 'lulc' in scenario_ds:
+        scenario_lulc_da = scenario_ds['lulc']
+    else:
+        scenario_lulc_da = make_scenario_ds.materialize_scenario_lulc_da(
+            scenario_ds, scenario_ds['change_num'].values)
+    scenario_dims = scenario_lulc_da.dims[:-2]
+    scenario_arrs = [
+        var_da.stack(scenario=scenario_dims).transpose(
+            'scenario', 'y', 'x').values
+        for var_da in (scenario_lulc_da, scenario_ds['T'])
+    ]
+    if 'scenario_run' in scenario_dims:
+        scenario_runs = scenario_lulc_da.stack(
+            scenario=scenario_dims)['scenario_run'].values
+    else:
+        scenario_runs = np.zeros(len(scenario_arrs[0]), dtype=int)
+    return scenario_arrs, scenario_runs, make_scenario_ds.get_rio_meta(
+        scenario_lulc_da)
+
+
+def drop_duplicate_scenarios(lulc_arrs, t_arrs, run_labels):
+    # keep only the first occurrence of each LULC array, e.g., the baseline
+    # (change_num 0) is in every scenario run of every dataset
+    lulc_digests = [
+        ucm_utils.get_lulc_digest(lulc_arr) for lulc_arr in lulc_arrs
+    ]
+    first_scenarios = np.sort(np.unique(lulc_digests, return_index=True)[1])
+    return (lulc_arrs[first_scenarios], t_arrs[first_scenarios],
+            run_labels[first_scenarios])
+
+
+def split_scenario_runs(run_labels, test_size, rng):
+    # split the scenarios into train and (held-out) test ones by scenario run,
+    # since the (nested) scenarios of a run share most of their pixels
+    runs, run_idx = np.unique(run_labels, return_inverse=True)
+    num_test_runs = int(round(test_size * len(runs)))
+    test_cond = np.isin(run_idx, rng.permutation(len(runs))[:num_test_runs])
+    return np.flatnonzero(~test_cond), np.flatnonzero(test_cond)
+
+
+@click.command()
+@click.argument('biophysical_table_filepath', type=click.Path(exists=True))
+@click.argument('ref_et_raster_filepath', type=click.Path(exists=True))
+@click.argument('calibrated_params_filepath', type=click.Path(exists=True))
+@click.argument('dst_filepath', type=click.Path())
+@click.option('--scenario-ds-filepath',
+              'scenario_ds_filepaths',
+              type=click.Path(exists=True),
+              multiple=True,
+              required=True,
+              help='Simulated scenario dataset used to train (and test) the '
+              'surrogate, can be provided multiple times')
+@click.option('--test-size',
+              type=float,
+              default=0.2,
+              required=False,
+              help='Proportion of held-out scenario runs to report the error')
+@click.option('--max-pixels',
+              type=int,
+              required=False,
+              help='Number of (random) pixels used to fit the surrogate')
+@click.option('--param-set',
+              type=int,
+              default=0,
+              required=False,
+              help='Parameter set of the ensemble scenario datasets (if any)')
+@click.option('--random-state', type=int, required=False)
+@click.option('--metrics-filepath', type=click.Path(), required=False)
+def main(biophysical_table_filepath, ref_et_raster_filepath,
+         calibrated_params_filepath, dst_filepath, scenario_ds_filepaths,
+         test_size, max_pixels, param_set, random_state, metrics_filepath):
+    logger = logging.getLogger(__name__)
+
+    # 1. read the simulated scenarios, labelling their run by dataset
+    lulc_arrs, t_arrs, run_labels = [], [], []
+    for i, scenario_ds_filepath in enumerate(scenario_ds_filepaths):
+        (_lulc_arrs, _t_arrs), scenario_runs, rio_meta = get_scenario_arrs(
+            scenario_encoding.open_scenario_ds(scenario_ds_filepath),
+            param_set=param_set)
+        lulc_arrs.append(_lulc_arrs)
+        t_arrs.append(_t_arrs)
+        run_labels.append(
+            [f'{i}-{scenario_run}' for scenario_run in scenario_runs])
+    lulc_arrs, t_arrs, run_labels = drop_duplicate_scenarios(
+        np.concatenate(lulc_arrs), np.concatenate(t_arrs),
+        np.concatenate(run_labels))
+    logger.info("read %d distinct simulated scenarios from %s",
+                len(lulc_arrs), ', '.join(scenario_ds_filepaths))
+
+    # 2. split them into train and (held-out) test scenario runs
+    rng = np.random.default_rng(random_state)
+    train_scenarios, test_scenarios = split_scenario_runs(
+        run_labels, test_size, rng)
+
+    # 3. fit the surrogate and report its error
+    with open(calibrated_params_filepath) as src:
+        ucm_params = json.load(src)
+    surrogate = ucm_surrogate.UCMSurrogate.from_biophysical_table(
+        biophysical_table_filepath,
+        rio_meta,
+        ref_et_raster_filepath=ref_et_raster_filepath,
+        ucm_params=ucm_params).fit(lulc_arrs[train_scenarios],
+                                   t_arrs[train_scenarios],
+                                   max_pixels=max_pixels,
+                                   random_state=rng)
+    logger.info("fitted the UCM surrogate on %d scenarios (%d held out)",
+                len(train_scenarios), len(test_scenarios))
+    metrics = dict(
+        train=surrogate.score(lulc_arrs[train_scenarios],
+                              t_arrs[train_scenarios]))
+    if len(test_scenarios) > 0:
+        metrics['test'] = surrogate.score(lulc_arrs[test_scenarios],
+                                          t_arrs[test_scenarios])
+    logger.info("UCM surrogate error: %s", metrics)
+    if metrics_filepath is not None:
+        with open(metrics_filepath, 'w') as dst:
+            json.dump(metrics, dst, indent=2)
+
+    surrogate.dump(dst_filepath)
+    logger.info("dumped UCM surrogate to %s", dst_filepath)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=settings.DEFAULT_LOG_FMT)
+
+    main()
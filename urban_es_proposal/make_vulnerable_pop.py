@@ -1,15 +1,176 @@
 import logging
+from os import path
 
 import click
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio as rio
 import swisslandstats as sls
 
-from urban_es_proposal import settings
+from urban_es_proposal import raster_utils, settings
 
 VULNERABLE_COLUMNS = [
     f'B19B{sex}{age_group:02}' for sex in ['M', 'W']
     for age_group in range(13, 20)
 ]
+# population groups (i.e., sums of STATPOP columns) written as the bands of
+# the output raster. The first band is the priority of the vulnerable
+# scenarios of `make_scenario_ds`
+POP_GROUPS = {
+    'vulnerable':
+    VULNERABLE_COLUMNS,
+    'vulnerable_men':
+    [column for column in VULNERABLE_COLUMNS if column[4] == 'M'],
+    'vulnerable_women':
+    [column for column in VULNERABLE_COLUMNS if column[4] == 'W'],
+    'total': ['B19BTOT'],
+}
+POP_DTYPE = 'float32'
+
+# columns of the hectare identifier and coordinates in the STATPOP CSV
+STATPOP_INDEX_COLUMN = 'RELI'
+STATPOP_X_COLUMN = 'E_KOORD'
+STATPOP_Y_COLUMN = 'N_KOORD'
+STATPOP_SEP = ';'
+# number of rows of the CSV chunks, and of the row groups of the columnar
+# cache, whose min/max coordinates allow skipping the row groups outside a
+# bbox when reading
+CHUNK_SIZE = 50000
+
+
+def _filter_bbox(df, bbox):
+    # rows whose hectare coordinates are within `bbox`
+    minx, miny, maxx, maxy = bbox
+    return df[df[STATPOP_X_COLUMN].between(minx, maxx)
+              & df[STATPOP_Y_COLUMN].between(miny, maxy)]
+
+
+def read_statpop_csv(statpop_filepath,
+                     columns=None,
+                     bbox=None,
+                     chunk_size=CHUNK_SIZE):
+    # stream the STATPOP CSV in chunks, only parsing the index, the
+    # coordinates and `columns` (all columns if `None`), and dropping the rows
+    # outside `bbox` (if provided) chunk by chunk
+    usecols = None
+    if columns is not None:
+        usecols = [STATPOP_INDEX_COLUMN, STATPOP_X_COLUMN, STATPOP_Y_COLUMN
+                   ] + list(columns)
+    chunks = pd.read_csv(statpop_filepath,
+                         sep=STATPOP_SEP,
+                         usecols=usecols,
+                         chunksize=chunk_size)
+    if bbox is not None:
+        chunks = (_filter_bbox(chunk, bbox) for chunk in chunks)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def dump_statpop_cache(statpop_filepath,
+                       cache_filepath,
+                       chunk_size=CHUNK_SIZE):
+    # cache the national STATPOP table (all of its columns) as a Parquet file
+    # sorted by coordinates, so that the row groups are horizontal strips of
+    # hectares and the columns can be read independently
+    statpop_df = read_statpop_csv(statpop_filepath,
+                                  chunk_size=chunk_size).sort_values(
+                                      [STATPOP_Y_COLUMN, STATPOP_X_COLUMN])
+    statpop_df.to_parquet(cache_filepath,
+                          index=False,
+                          row_group_size=chunk_size)
+
+
+def read_statpop_cache(cache_filepath, columns=None, bbox=None):
+    # read `columns` (all if `None`) of the rows within `bbox` of the cache,
+    # skipping the row groups outside it
+    if columns is not None:
+        columns = [STATPOP_INDEX_COLUMN, STATPOP_X_COLUMN, STATPOP_Y_COLUMN
+                   ] + list(columns)
+    filters = None
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        filters = [(STATPOP_X_COLUMN, '>=', minx),
+                   (STATPOP_X_COLUMN, '<=', maxx),
+                   (STATPOP_Y_COLUMN, '>=', miny),
+                   (STATPOP_Y_COLUMN, '<=', maxy)]
+    return pd.read_parquet(cache_filepath, columns=columns, filters=filters)
+
+
+def read_statpop(statpop_filepath,
+                 columns=None,
+                 bbox=None,
+                 cache_filepath=None,
+                 chunk_size=CHUNK_SIZE):
+    # read the STATPOP rows within `bbox` as a land data frame, either
+    # streaming the CSV or, if `cache_filepath` is provided, from the
+    # columnar cache, which is (re)built if it is older than the CSV
+    logger = logging.getLogger(__name__)
+    if cache_filepath is None:
+        statpop_df = read_statpop_csv(statpop_filepath,
+                                      columns=columns,
+                                      bbox=bbox,
+                                      chunk_size=chunk_size)
+    else:
+        if not path.exists(cache_filepath) or path.getmtime(
+                cache_filepath) < path.getmtime(statpop_filepath):
+            dump_statpop_cache(statpop_filepath,
+                               cache_filepath,
+                               chunk_size=chunk_size)
+            logger.info("cached %s to %s", statpop_filepath, cache_filepath)
+        statpop_df = read_statpop_cache(cache_filepath,
+                                        columns=columns,
+                                        bbox=bbox)
+    # same CRS and resolution as `sls.read_csv`
+    return sls.LandDataFrame(statpop_df,
+                             index_column=STATPOP_INDEX_COLUMN,
+                             x_column=STATPOP_X_COLUMN,
+                             y_column=STATPOP_Y_COLUMN,
+                             crs=sls.settings.DEFAULT_CRS,
+                             res=sls.settings.DEFAULT_RES)
+
+
+def get_hectare_arr(ldf, group_df):
+    # (group, row, column) array of the group populations on the hectare grid
+    # of the land data frame, along with its transform
+    hectare_transform = ldf.get_transform()
+    xres, yres = ldf.res
+    cols = ((ldf[ldf.x_column] - hectare_transform.c) // xres).astype(int)
+    rows = ((hectare_transform.f - ldf[ldf.y_column]) // yres).astype(int)
+    hectare_arr = np.zeros((len(group_df.columns), rows.max() + 1,
+                            cols.max() + 1))
+    hectare_arr[:, rows, cols] = group_df.to_numpy().T
+    return hectare_arr, hectare_transform
+
+
+def get_overlap_weights(src_start, src_res, src_size, dst_start, dst_res,
+                        dst_size):
+    # (dst_size, src_size) fractions of the length of each source cell (along
+    # one axis) that falls within each destination cell
+    src_starts = src_start + src_res * np.arange(src_size)
+    dst_starts = dst_start + dst_res * np.arange(dst_size)[:, np.newaxis]
+    overlaps = np.minimum(dst_starts + dst_res,
+                          src_starts + src_res) - np.maximum(
+                              dst_starts, src_starts)
+    return np.clip(overlaps, 0, None) / src_res
+
+
+def resample_sum(src_arr, src_transform, dst_shape, dst_transform):
+    # mass-conserving resampling of the (band, row, column) `src_arr` onto a
+    # (non-rotated) grid: each source cell is distributed among the
+    # destination cells according to their overlapping area. Since both grids
+    # are axis-aligned, the overlaps are the product of the row and column
+    # overlaps, so each band is resampled with two matrix products. The
+    # y-axes are flipped so that their coordinates increase with the rows
+    _, src_height, src_width = src_arr.shape
+    dst_height, dst_width = dst_shape
+    row_weights = get_overlap_weights(-src_transform.f, -src_transform.e,
+                                      src_height, -dst_transform.f,
+                                      -dst_transform.e, dst_height)
+    col_weights = get_overlap_weights(src_transform.c, src_transform.a,
+                                      src_width, dst_transform.c,
+                                      dst_transform.a, dst_width)
+    return np.stack(
+        [row_weights @ band_arr @ col_weights.T for band_arr in src_arr])
 
 
 # utils for the CLI
@@ -59,29 +220,106 @@ class OptionEatAll(click.Option):
         return retval
 
 
+def parse_pop_groups(ctx, param, value):
+    # "NAME=COLUMN[,COLUMN...]" values to a dict of population groups
+    pop_groups = {}
+    for pop_group in value:
+        name, sep, columns = pop_group.partition('=')
+        if not sep or not columns:
+            raise click.BadParameter(
+                f"{pop_group} does not follow NAME=COLUMN[,COLUMN...]")
+        pop_groups[name] = columns.split(',')
+    return pop_groups
+
+
 @click.command()
 @click.argument('statpop_filepath', type=click.Path(exists=True))
 @click.argument('agglom_extent_filepath', type=click.Path(exists=True))
 @click.argument('dst_filepath', type=click.Path())
 @click.option('--vulnerable-columns', cls=OptionEatAll, required=False)
+@click.option('--pop-group',
+              'pop_groups',
+              multiple=True,
+              callback=parse_pop_groups,
+              help='Population group written as a band, as '
+              'NAME=COLUMN[,COLUMN...]. Can be repeated to replace the '
+              'default groups')
+@click.option('--grid-filepath',
+              type=click.Path(exists=True),
+              required=False,
+              help='Raster (e.g., the reclassified LULC) whose grid the '
+              'population is resampled onto (by default, the STATPOP grid)')
 @click.option('--buffer-dist', default=100, required=False)
+@click.option('--cache-filepath',
+              type=click.Path(),
+              required=False,
+              help='Columnar (Parquet) cache of the STATPOP table, which is '
+              'built on the first run')
+@click.option('--chunk-size',
+              type=int,
+              default=CHUNK_SIZE,
+              required=False,
+              help='Number of rows of the CSV chunks')
+@click.option('--compress',
+              type=click.Choice(raster_utils.COMPRESS_METHODS),
+              required=False)
 def main(statpop_filepath, agglom_extent_filepath, dst_filepath,
-         vulnerable_columns, buffer_dist):
+         vulnerable_columns, pop_groups, grid_filepath, buffer_dist,
+         cache_filepath, chunk_size, compress):
     logger = logging.getLogger(__name__)
 
+    if not pop_groups:
+        pop_groups = POP_GROUPS.copy()
+    if vulnerable_columns is not None:
+        pop_groups['vulnerable'] = list(vulnerable_columns)
+    # the vulnerable population is always the first band, i.e., the one that
+    # make_scenario_ds reads from rasters without band descriptions
+    if 'vulnerable' in pop_groups:
+        pop_groups = {'vulnerable': pop_groups.pop('vulnerable'), **pop_groups}
+    columns = list(
+        dict.fromkeys(column for group_columns in pop_groups.values()
+                      for column in group_columns))
+
     gdf = gpd.read_file(agglom_extent_filepath)
-    ldf = sls.read_csv(statpop_filepath,
-                       x_column='E_KOORD',
-                       y_column='N_KOORD').clip_by_geometry(
-                           gdf['geometry'].iloc[0].buffer(buffer_dist),
-                           gdf.crs)
-
-    if vulnerable_columns is None:
-        vulnerable_columns = VULNERABLE_COLUMNS
-    ldf['vulnerable'] = ldf[vulnerable_columns].sum(axis=1)
-
-    ldf.to_geotiff(dst_filepath, 'vulnerable')
-    logger.info("dumped vulnerable population raster to %s", dst_filepath)
+    extent_geom = gdf['geometry'].iloc[0].buffer(buffer_dist)
+    # only read the columns of the population groups of the rows within the
+    # bbox of the extent, which are then clipped to its exact geometry
+    ldf = read_statpop(statpop_filepath,
+                       columns=columns,
+                       bbox=extent_geom.bounds,
+                       cache_filepath=cache_filepath,
+                       chunk_size=chunk_size).clip_by_geometry(
+                           extent_geom, gdf.crs)
+    group_df = pd.DataFrame({
+        name: ldf[group_columns].sum(axis=1)
+        for name, group_columns in pop_groups.items()
+    })
+
+    pop_arr, transform = get_hectare_arr(ldf, group_df)
+    crs = rio.crs.CRS.from_user_input(ldf.crs)
+    if grid_filepath is not None:
+        with rio.open(grid_filepath) as src:
+            if src.crs != crs:
+                raise ValueError(f"the CRS of {grid_filepath} ({src.crs}) "
+                                 f"is not the one of STATPOP ({crs})")
+            pop_arr = resample_sum(pop_arr, transform, src.shape,
+                                   src.transform)
+            transform = src.transform
+
+    with raster_utils.open_raster(dst_filepath,
+                                  profile='continuous',
+                                  compress=compress,
+                                  width=pop_arr.shape[2],
+                                  height=pop_arr.shape[1],
+                                  count=len(pop_arr),
+                                  dtype=POP_DTYPE,
+                                  crs=crs,
+                                  transform=transform) as dst:
+        dst.write(pop_arr.astype(POP_DTYPE))
+        for band, name in enumerate(pop_groups, start=1):
+            dst.set_band_description(band, name)
+    logger.info("dumped population raster of %s to %s", ', '.join(pop_groups),
+                dst_filepath)
 
 
 if __name__ == '__main__':
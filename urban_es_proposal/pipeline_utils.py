@@ -0,0 +1,262 @@
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import types
+import uuid
+from concurrent import futures
+from os import path
+
+from urban_es_proposal import data_cache
+
+# number of stages that can run concurrently
+MAX_WORKERS = 4
+
+
+def run_command(command, args):
+    # run a click command (or group) in this process rather than in a new
+    # interpreter, parsing `args` as if they came from the command line
+    return command.main(args=[str(arg) for arg in args],
+                        prog_name=command.name,
+                        standalone_mode=False)
+
+
+def run_module(module, args):
+    # run a script (i.e., a module with a `__main__` block) of this package in
+    # a new interpreter, as if it was called from the Makefile
+    subprocess.run([sys.executable, '-m', module.__name__] +
+                   [str(arg) for arg in args],
+                   check=True)
+
+
+def get_code_modules(modules, shallow_modules=()):
+    # `modules` along with the modules of this package that they (transitively)
+    # import, whose source code determines the output of a stage. The imports
+    # of `shallow_modules` are not followed, e.g., a pipeline script that
+    # defines some stage functions but imports the modules of every stage
+    package = __name__.split('.')[0]
+    code_modules = {module.__name__: module for module in shallow_modules}
+    stack = list(modules)
+    while stack:
+        module = stack.pop()
+        if module.__name__ in code_modules:
+            continue
+        code_modules[module.__name__] = module
+        stack += [
+            value for value in vars(module).values()
+            if isinstance(value, types.ModuleType)
+            and value.__name__.split('.')[0] == package
+        ]
+    return list(code_modules.values())
+
+
+class Stage:
+    # step of a pipeline, i.e., a function of `params` that dumps
+    # `dst_filepaths` from `src_filepaths`, once its upstream stages (`deps`)
+    # are done. It may return a value that is passed in memory (as a keyword
+    # argument named after the stage) to the downstream stages that list it
+    # in `value_deps`, and that `load` gets back from `dst_filepaths` when the
+    # stage is memoised. The stage is memoised by its `params`, the content of
+    # its `src_filepaths` and the source code of `modules` and
+    # `shallow_modules` (see `get_code_modules`)
+    def __init__(self,
+                 name,
+                 func,
+                 deps=(),
+                 value_deps=(),
+                 src_filepaths=(),
+                 dst_filepaths=(),
+                 params=None,
+                 modules=(),
+                 shallow_modules=(),
+                 load=None):
+        self.name = name
+        self.func = func
+        self.value_deps = list(value_deps)
+        self.deps = list(dict.fromkeys(list(deps) + self.value_deps))
+        self.src_filepaths = list(src_filepaths)
+        self.dst_filepaths = list(dst_filepaths)
+        self.params = params or {}
+        self.modules = get_code_modules(modules,
+                                        shallow_modules=shallow_modules)
+        self.load = load
+
+
+class StageMemo:
+    # key with which each stage was last run (under `memo_dir`), along with
+    # the digests of the files by size and modification time so that the
+    # files that did not change are not hashed again
+    def __init__(self, memo_dir):
+        self.memo_dir = memo_dir
+        os.makedirs(memo_dir, exist_ok=True)
+        self._digests_filepath = path.join(memo_dir, 'digests.json')
+        try:
+            with open(self._digests_filepath) as src:
+                self._digests = json.load(src)
+        except (OSError, ValueError):
+            self._digests = {}
+        self._lock = threading.Lock()
+
+    def _dump_json(self, obj, dst_filepath):
+        # write to a temporary file and rename so that records are atomic
+        tmp_filepath = f'{dst_filepath}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filepath, 'w') as dst:
+            json.dump(obj, dst)
+        os.replace(tmp_filepath, dst_filepath)
+
+    def get_file_digest(self, filepath):
+        filepath = path.abspath(filepath)
+        stat = os.stat(filepath)
+        file_stat = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            digest_entry = self._digests.get(filepath)
+        if digest_entry is not None and digest_entry[:2] == file_stat:
+            return digest_entry[2]
+        digest = data_cache.get_file_digest(filepath)
+        with self._lock:
+            self._digests[filepath] = file_stat + [digest]
+        return digest
+
+    def get_key(self, stage):
+        return hashlib.sha256(
+            json.dumps(dict(name=stage.name,
+                            params=stage.params,
+                            code={
+                                module.__name__:
+                                self.get_file_digest(module.__file__)
+                                for module in stage.modules
+                            },
+                            src={
+                                src_filepath:
+                                self.get_file_digest(src_filepath)
+                                for src_filepath in stage.src_filepaths
+                            }),
+                       sort_keys=True,
+                       default=str).encode()).hexdigest()
+
+    def _get_record_filepath(self, stage):
+        return path.join(self.memo_dir, f'{stage.name}.json')
+
+    def is_memoised(self, stage, key):
+        # whether the stage was last run with `key` and its outputs are there
+        try:
+            with open(self._get_record_filepath(stage)) as src:
+                record = json.load(src)
+        except (OSError, ValueError):
+            return False
+        return record.get('key') == key and all(
+            path.exists(dst_filepath) for dst_filepath in stage.dst_filepaths)
+
+    def dump_digests(self):
+        with self._lock:
+            self._dump_json(self._digests, self._digests_filepath)
+
+    def dump(self, stage, key):
+        self._dump_json(dict(key=key, dst_filepaths=stage.dst_filepaths),
+                        self._get_record_filepath(stage))
+        self.dump_digests()
+
+
+def get_needed_stages(stage_dict, targets=None):
+    # names of the stages needed for `targets` (all the stages by default)
+    if targets is None:
+        targets = list(stage_dict)
+    names = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name in names:
+            continue
+        if name not in stage_dict:
+            raise ValueError(f"there is no stage named {name}")
+        names.add(name)
+        stack += stage_dict[name].deps
+    return names
+
+
+class StageValues:
+    # in-memory values of the stages that were run, or loaded from the
+    # outputs of memoised stages when a downstream stage needs them
+    def __init__(self, stage_dict):
+        self.stage_dict = stage_dict
+        self._values = {}
+        self._locks = {name: threading.Lock() for name in stage_dict}
+
+    def get(self, name):
+        with self._locks[name]:
+            if name not in self._values:
+                self._values[name] = self.stage_dict[name].load()
+            return self._values[name]
+
+    def set(self, name, value):
+        with self._locks[name]:
+            self._values[name] = value
+
+
+def evaluate_stage(stage, memo, stage_values, force=()):
+    # run the stage unless it is memoised (and not listed in `force`),
+    # returning whether it was run
+    key = memo.get_key(stage)
+    if stage.name not in force and memo.is_memoised(stage, key):
+        return False
+    for dst_filepath in stage.dst_filepaths:
+        os.makedirs(path.dirname(dst_filepath) or '.', exist_ok=True)
+    stage_values.set(
+        stage.name,
+        stage.func(**{dep: stage_values.get(dep)
+                      for dep in stage.value_deps}, **stage.params))
+    memo.dump(stage, key)
+    return True
+
+
+def run_pipeline(stages,
+                 memo_dir,
+                 targets=None,
+                 max_workers=MAX_WORKERS,
+                 force=()):
+    # run the stages needed for `targets` in threads of this process (unless
+    # they run their own interpreter), each as soon as its upstream stages
+    # are done (so that independent branches run
+    # concurrently) and only if it is not memoised or listed in `force`.
+    # Since the memo keys depend on the content of the source files, the
+    # downstream stages of a stage whose outputs did not change are not run
+    # again. Returns the names of the stages that were run
+    logger = logging.getLogger(__name__)
+    stage_dict = {stage.name: stage for stage in stages}
+    pending = get_needed_stages(stage_dict, targets=targets)
+    memo = StageMemo(memo_dir)
+    stage_values = StageValues(stage_dict)
+
+    ran = []
+    done = set()
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_name = {}
+        while pending or future_to_name:
+            for name in sorted(pending):
+                if done.issuperset(stage_dict[name].deps):
+                    pending.remove(name)
+                    future_to_name[executor.submit(evaluate_stage,
+                                                   stage_dict[name],
+                                                   memo,
+                                                   stage_values,
+                                                   force=force)] = name
+            if not future_to_name:
+                raise ValueError("the dependencies of stages "
+                                 f"{', '.join(sorted(pending))} are cyclic")
+            for future in futures.wait(
+                    future_to_name,
+                    return_when=futures.FIRST_COMPLETED).done:
+                name = future_to_name.pop(future)
+                if future.result():
+                    ran.append(name)
+                    logger.info("ran stage %s", name)
+                else:
+                    logger.info("stage %s is memoised, skipping it", name)
+                done.add(name)
+    # also keep the digests of the files of the memoised stages
+    memo.dump_digests()
+
+    return ran
@@ -0,0 +1,86 @@
+import contextlib
+import os
+import tempfile
+from os import path
+
+import numpy as np
+import rasterio as rio
+from rasterio import enums, shutil
+
+# block size of the tiled outputs, which is also the size under which no
+# further overviews are built
+BLOCK_SIZE = 512
+
+# compression methods that can be set from the command line
+COMPRESS_METHODS = ['deflate', 'zstd', 'lzw', 'none']
+
+# output profiles of the rasters written by the package, i.e., (GDAL 2
+# compatible) cloud-optimized GeoTIFFs whose overviews are resampled according
+# to the nature of the data, or plain uncompressed GeoTIFFs for temporary
+# rasters that are written once and read right away (e.g., the LULC inputs of
+# the UCM)
+RASTER_PROFILES = {
+    'categorical': dict(compress='deflate', overview_resampling='nearest'),
+    'continuous': dict(compress='deflate', overview_resampling='average'),
+    'temp': dict(compress=None, overview_resampling=None),
+}
+
+
+def get_creation_options(dtype, compress=None):
+    # tiled GeoTIFF creation options, with the predictor that suits `dtype`
+    creation_options = dict(tiled=True,
+                            blockxsize=BLOCK_SIZE,
+                            blockysize=BLOCK_SIZE)
+    if compress not in [None, 'none']:
+        creation_options.update(
+            compress=compress,
+            predictor=3 if np.issubdtype(dtype, np.floating) else 2)
+    return creation_options
+
+
+def get_overview_factors(height, width):
+    factors = []
+    factor = 2
+    while max(height, width) / factor >= BLOCK_SIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+@contextlib.contextmanager
+def open_raster(dst_filepath, profile='categorical', compress=None, **meta):
+    # open `dst_filepath` for writing with the given profile (see
+    # `RASTER_PROFILES`), whose compression can be overridden with `compress`
+    # (e.g., 'zstd', which requires GDAL >= 2.3, or 'none'). Cloud-optimized
+    # GeoTIFFs are first written (possibly by windows) as an uncompressed
+    # tiled temporary file, whose overviews are then built and copied along
+    # with the data into the compressed `dst_filepath`
+    profile = RASTER_PROFILES[profile]
+    if compress is not None:
+        profile = dict(profile, compress=compress)
+    meta = dict(meta, driver='GTiff')
+    if profile['overview_resampling'] is None:
+        with rio.open(dst_filepath, 'w', **meta) as dst:
+            yield dst
+        return
+
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.tif',
+                                        dir=path.dirname(dst_filepath)
+                                        or None)
+    os.close(fd)
+    try:
+        with rio.open(tmp_filepath, 'w', **meta,
+                      **get_creation_options(meta['dtype'])) as dst:
+            yield dst
+        with rio.open(tmp_filepath, 'r+') as dst:
+            dst.build_overviews(
+                get_overview_factors(dst.height, dst.width),
+                enums.Resampling[profile['overview_resampling']])
+        shutil.copy(tmp_filepath,
+                    dst_filepath,
+                    driver='GTiff',
+                    copy_src_overviews=True,
+                    **get_creation_options(meta['dtype'],
+                                           compress=profile['compress']))
+    finally:
+        os.remove(tmp_filepath)
@@ -0,0 +1,354 @@
+import functools
+import json
+import logging
+import shutil
+import sys
+import zipfile
+from importlib import metadata
+from os import path
+
+import click
+import dotenv
+import geopandas as gpd
+
+from urban_es_proposal import (cadastre_utils, data_cache, fetch_data,
+                               make_agglom_lulc, make_bldg_cover,
+                               make_cadastre_shp_from_zip,
+                               make_candidate_pixels, make_scenario_ds,
+                               make_ucm_surrogate, make_vulnerable_pop,
+                               pipeline_utils, settings)
+
+# paths of the Makefile
+DATA_DIR = 'data'
+DATA_RAW_DIR = path.join(DATA_DIR, 'raw')
+DATA_INTERIM_DIR = path.join(DATA_DIR, 'interim')
+DATA_PROCESSED_DIR = path.join(DATA_DIR, 'processed')
+DATA_MANIFEST_JSON = 'data-manifest.json'
+# memo of the stages of the pipeline
+MEMO_DIR = path.join(DATA_INTERIM_DIR, 'pipeline-memo')
+
+# raw data, fetched from the manifest
+RAW_DATA = {
+    'cadastre_zip': path.join(DATA_RAW_DIR, 'cadastre', 'cadastre.zip'),
+    'tree_canopy': path.join(DATA_RAW_DIR, 'tree-canopy.tif'),
+    'biophysical_table': path.join(DATA_RAW_DIR, 'biophysical-table.csv'),
+    'statpop_zip': path.join(DATA_RAW_DIR, 'statpop', 'statpop-2019.zip'),
+    'calibrated_params': path.join(DATA_RAW_DIR,
+                                   'invest-calibrated-params.json'),
+    'station_t': path.join(DATA_RAW_DIR, 'station-t.csv'),
+    'ref_et': path.join(DATA_RAW_DIR, 'ref-et.tif'),
+}
+AGGLOM_EXTENT_SHP = path.join(DATA_RAW_DIR, 'agglom-extent',
+                              'agglom-extent.shp')
+CADASTRE_UNZIP_FILEPATTERN = 'Cadastre/(NPCS|MOVD)_CAD_TPR_(BATHS|CSBOIS|' \
+    'CSDIV|CSDUR|CSEAU|CSVERT)_S.*'
+STATPOP_CSV_MEMBER = 'STATPOP2019.csv'
+NUM_SCENARIO_RUNS = 3
+
+# intermediate and processed data
+CADASTRE_PARQUET = path.join(DATA_RAW_DIR, 'cadastre', 'cadastre.parquet')
+AGGLOM_LULC_TIF = path.join(DATA_INTERIM_DIR, 'agglom-lulc.tif')
+TREE_COVER_TIF = path.join(DATA_INTERIM_DIR, 'tree-cover.tif')
+BLDG_COVER_TIF = path.join(DATA_RAW_DIR, 'bldg-cover.tif')
+RECLASSIF_LULC_TIF = path.join(DATA_PROCESSED_DIR, 'agglom-lulc.tif')
+RECLASSIF_TABLE_CSV = path.join(DATA_PROCESSED_DIR, 'biophysical-table.csv')
+CANDIDATE_PIXELS_TIF = path.join(DATA_PROCESSED_DIR, 'candidate-pixels.tif')
+STATPOP_CSV = path.join(DATA_RAW_DIR, 'statpop', 'statpop-2019.csv')
+STATPOP_PARQUET = path.join(DATA_RAW_DIR, 'statpop', 'statpop-2019.parquet')
+VULNERABLE_POP_TIF = path.join(DATA_PROCESSED_DIR, 'vulnerable-pop.tif')
+SCENARIOS_RANDOM_NC = path.join(DATA_PROCESSED_DIR, 'scenarios-random.nc')
+SCENARIOS_VULNERABLE_NC = path.join(DATA_PROCESSED_DIR,
+                                    'scenarios-vulnerable.nc')
+SCENARIOS_T_CACHE_DIR = path.join(DATA_INTERIM_DIR, 'scenarios-t-cache')
+UCM_SURROGATE_NPZ = path.join(DATA_INTERIM_DIR, 'ucm-surrogate.npz')
+
+# console script of swiss-uhi-utils (for the reclassification steps)
+SWISS_UHI_UTILS_SCRIPT = 'swiss-uhi-utils'
+
+# this module, which defines the functions of some stages, so that editing
+# them invalidates the memo of those stages (but not editing the modules of
+# the other stages, which it imports)
+THIS_MODULE = sys.modules[__name__]
+
+
+# stage functions
+def fetch_raw_data(entry, cache_dir=fetch_data.DATA_CACHE_DIR):
+    failed = fetch_data.fetch_manifest([entry],
+                                       data_cache.DataCache(cache_dir),
+                                       max_workers=1)
+    if failed:
+        raise failed[0][1]
+
+
+def extract_zip_member(zip_filepath, member, dst_filepath):
+    with zipfile.ZipFile(zip_filepath) as zf, zf.open(member) as src, open(
+            dst_filepath, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+
+def make_cadastre(input_filepath, unzip_filepattern, dst_filepath):
+    # the cadastre is dumped (to be memoised) and passed in memory
+    cadastre_gdf = make_cadastre_shp_from_zip.get_cadastre_gdf(
+        input_filepath, unzip_filepattern)
+    cadastre_utils.dump_cadastre(cadastre_gdf, dst_filepath)
+    return cadastre_gdf
+
+
+def make_agglom_lulc_tif(cadastre, agglom_extent_filepath, dst_filepath):
+    make_agglom_lulc.dump_agglom_lulc_pyramid(
+        cadastre,
+        gpd.read_file(agglom_extent_filepath)['geometry'].iloc[:1],
+        dst_filepath)
+
+
+def make_bldg_cover_tif(cadastre, agglom_lulc_filepath, dst_filepath):
+    make_bldg_cover.dump_bldg_cover(agglom_lulc_filepath, cadastre,
+                                    dst_filepath)
+
+
+def run_console_script(args, name=SWISS_UHI_UTILS_SCRIPT):
+    # run the (click) console script of another package in this process
+    (entry_point, ) = metadata.entry_points(group='console_scripts',
+                                            name=name)
+    pipeline_utils.run_command(entry_point.load(), args)
+
+
+def script_stage(name, module, args, isolate=False, **stage_kws):
+    # stage that runs the command of a `make_*` script of this package with
+    # `args`, as if it was called from the Makefile. Since the stages run as
+    # threads of this process, the scripts that start process pools or set
+    # process-wide state (i.e., the dask configuration and the UCM workers)
+    # must be `isolate`d in their own interpreter
+    if isolate:
+        func = functools.partial(pipeline_utils.run_module, module)
+    else:
+        func = functools.partial(pipeline_utils.run_command, module.main)
+    return pipeline_utils.Stage(name,
+                                func,
+                                params=dict(args=[str(arg) for arg in args]),
+                                modules=[module],
+                                **stage_kws)
+
+
+def console_script_stage(name, args, **stage_kws):
+    # stage that runs a swiss-uhi-utils command with `args`. Its code is not
+    # memoised, so the stage must be forced when swiss-uhi-utils is updated
+    return pipeline_utils.Stage(name,
+                                run_console_script,
+                                params=dict(args=[str(arg) for arg in args]),
+                                shallow_modules=[THIS_MODULE],
+                                **stage_kws)
+
+
+def get_stages(manifest_filepath=DATA_MANIFEST_JSON,
+               cache_dir=fetch_data.DATA_CACHE_DIR,
+               num_scenario_runs=NUM_SCENARIO_RUNS):
+    # stages of the pipeline, which mirror the rules of the Makefile
+    with open(manifest_filepath) as src:
+        manifest = {
+            path.normpath(entry['dst']): entry
+            for entry in json.load(src)
+        }
+    stages = [
+        pipeline_utils.Stage(name,
+                             functools.partial(fetch_raw_data,
+                                               cache_dir=cache_dir),
+                             dst_filepaths=[dst_filepath],
+                             params=dict(entry=manifest[dst_filepath]),
+                             shallow_modules=[THIS_MODULE])
+        for name, dst_filepath in RAW_DATA.items()
+    ]
+
+    # cadastre and LULC rasters
+    stages += [
+        pipeline_utils.Stage(
+            'cadastre',
+            make_cadastre,
+            deps=['cadastre_zip'],
+            src_filepaths=[RAW_DATA['cadastre_zip']],
+            dst_filepaths=[CADASTRE_PARQUET],
+            params=dict(input_filepath=RAW_DATA['cadastre_zip'],
+                        unzip_filepattern=CADASTRE_UNZIP_FILEPATTERN,
+                        dst_filepath=CADASTRE_PARQUET),
+            modules=[make_cadastre_shp_from_zip],
+            shallow_modules=[THIS_MODULE],
+            load=functools.partial(cadastre_utils.read_cadastre,
+                                   CADASTRE_PARQUET)),
+        pipeline_utils.Stage(
+            'agglom_lulc',
+            make_agglom_lulc_tif,
+            value_deps=['cadastre'],
+            src_filepaths=[CADASTRE_PARQUET, AGGLOM_EXTENT_SHP],
+            dst_filepaths=[AGGLOM_LULC_TIF],
+            params=dict(agglom_extent_filepath=AGGLOM_EXTENT_SHP,
+                        dst_filepath=AGGLOM_LULC_TIF),
+            modules=[make_agglom_lulc],
+            shallow_modules=[THIS_MODULE]),
+        console_script_stage(
+            'tree_cover', [
+                'compute-feature-cover', AGGLOM_LULC_TIF,
+                RAW_DATA['tree_canopy'], TREE_COVER_TIF
+            ],
+            deps=['agglom_lulc', 'tree_canopy'],
+            src_filepaths=[AGGLOM_LULC_TIF, RAW_DATA['tree_canopy']],
+            dst_filepaths=[TREE_COVER_TIF]),
+        pipeline_utils.Stage(
+            'bldg_cover',
+            make_bldg_cover_tif,
+            deps=['agglom_lulc'],
+            value_deps=['cadastre'],
+            src_filepaths=[AGGLOM_LULC_TIF, CADASTRE_PARQUET],
+            dst_filepaths=[BLDG_COVER_TIF],
+            params=dict(agglom_lulc_filepath=AGGLOM_LULC_TIF,
+                        dst_filepath=BLDG_COVER_TIF),
+            modules=[make_bldg_cover],
+            shallow_modules=[THIS_MODULE]),
+        console_script_stage(
+            'reclassify', [
+                'reclassify', AGGLOM_LULC_TIF, TREE_COVER_TIF,
+                BLDG_COVER_TIF, RAW_DATA['biophysical_table'],
+                RECLASSIF_LULC_TIF, RECLASSIF_TABLE_CSV
+            ],
+            deps=[
+                'agglom_lulc', 'tree_cover', 'bldg_cover', 'biophysical_table'
+            ],
+            src_filepaths=[
+                AGGLOM_LULC_TIF, TREE_COVER_TIF, BLDG_COVER_TIF,
+                RAW_DATA['biophysical_table']
+            ],
+            dst_filepaths=[RECLASSIF_LULC_TIF, RECLASSIF_TABLE_CSV]),
+        script_stage(
+            'candidate_pixels',
+            make_candidate_pixels,
+            [RECLASSIF_LULC_TIF, RECLASSIF_TABLE_CSV, CANDIDATE_PIXELS_TIF],
+            deps=['reclassify'],
+            src_filepaths=[RECLASSIF_LULC_TIF, RECLASSIF_TABLE_CSV],
+            dst_filepaths=[CANDIDATE_PIXELS_TIF]),
+    ]
+
+    # population
+    stages += [
+        pipeline_utils.Stage('statpop',
+                             extract_zip_member,
+                             deps=['statpop_zip'],
+                             src_filepaths=[RAW_DATA['statpop_zip']],
+                             dst_filepaths=[STATPOP_CSV],
+                             params=dict(zip_filepath=RAW_DATA['statpop_zip'],
+                                         member=STATPOP_CSV_MEMBER,
+                                         dst_filepath=STATPOP_CSV),
+                             shallow_modules=[THIS_MODULE]),
+        script_stage('vulnerable_pop',
+                     make_vulnerable_pop, [
+                         STATPOP_CSV, AGGLOM_EXTENT_SHP, VULNERABLE_POP_TIF,
+                         '--grid-filepath', RECLASSIF_LULC_TIF,
+                         '--cache-filepath', STATPOP_PARQUET
+                     ],
+                     deps=['statpop', 'reclassify'],
+                     src_filepaths=[
+                         STATPOP_CSV, AGGLOM_EXTENT_SHP, RECLASSIF_LULC_TIF
+                     ],
+                     dst_filepaths=[VULNERABLE_POP_TIF]),
+    ]
+
+    # heat mitigation
+    scenario_args = [
+        RECLASSIF_LULC_TIF, RECLASSIF_TABLE_CSV, RAW_DATA['ref_et'],
+        RAW_DATA['station_t'], RAW_DATA['calibrated_params']
+    ]
+    scenario_deps = ['reclassify', 'ref_et', 'station_t', 'calibrated_params']
+    stages += [
+        script_stage('scenarios_random',
+                     make_scenario_ds,
+                     scenario_args + [
+                         '--num-scenario-runs', num_scenario_runs,
+                         '--cache-dir', SCENARIOS_T_CACHE_DIR,
+                         SCENARIOS_RANDOM_NC
+                     ],
+                     deps=scenario_deps,
+                     src_filepaths=scenario_args,
+                     dst_filepaths=[SCENARIOS_RANDOM_NC],
+                     isolate=True),
+        script_stage('scenarios_vulnerable',
+                     make_scenario_ds,
+                     scenario_args + [
+                         '--vulnerable-pop-filepath', VULNERABLE_POP_TIF,
+                         '--cache-dir', SCENARIOS_T_CACHE_DIR,
+                         SCENARIOS_VULNERABLE_NC
+                     ],
+                     # each scenario stage uses all the cores, so they run
+                     # one after the other (which also lets this one reuse
+                     # the cached temperatures, e.g., of the baseline)
+                     deps=scenario_deps +
+                     ['vulnerable_pop', 'scenarios_random'],
+                     src_filepaths=scenario_args + [VULNERABLE_POP_TIF],
+                     dst_filepaths=[SCENARIOS_VULNERABLE_NC],
+                     isolate=True),
+        script_stage('ucm_surrogate',
+                     make_ucm_surrogate, [
+                         RECLASSIF_TABLE_CSV, RAW_DATA['ref_et'],
+                         RAW_DATA['calibrated_params'],
+                         '--scenario-ds-filepath', SCENARIOS_RANDOM_NC,
+                         '--scenario-ds-filepath', SCENARIOS_VULNERABLE_NC,
+                         UCM_SURROGATE_NPZ
+                     ],
+                     deps=['scenarios_random', 'scenarios_vulnerable'],
+                     src_filepaths=[
+                         RECLASSIF_TABLE_CSV, RAW_DATA['ref_et'],
+                         RAW_DATA['calibrated_params'], SCENARIOS_RANDOM_NC,
+                         SCENARIOS_VULNERABLE_NC
+                     ],
+                     dst_filepaths=[UCM_SURROGATE_NPZ]),
+    ]
+
+    return stages
+
+
+@click.command()
+@click.argument('targets', nargs=-1)
+@click.option('--memo-dir',
+              type=click.Path(),
+              default=MEMO_DIR,
+              required=False,
+              help='Directory of the memo of the stages')
+@click.option('--max-workers',
+              type=int,
+              default=pipeline_utils.MAX_WORKERS,
+              required=False,
+              help='Number of stages run concurrently')
+@click.option('--force',
+              multiple=True,
+              help='Stage to run even if it is memoised. Can be provided '
+              'multiple times')
+@click.option('--cache-dir',
+              type=click.Path(),
+              envvar='DATA_CACHE_DIR',
+              default=fetch_data.DATA_CACHE_DIR,
+              required=False,
+              help='Data cache directory to fetch the raw data')
+@click.option('--num-scenario-runs',
+              type=int,
+              default=NUM_SCENARIO_RUNS,
+              required=False)
+def main(targets, memo_dir, max_workers, force, cache_dir, num_scenario_runs):
+    logger = logging.getLogger(__name__)
+
+    # run the stages of the targets (all by default) and their upstream
+    # stages that are not memoised in this process
+    stages = get_stages(cache_dir=cache_dir,
+                        num_scenario_runs=num_scenario_runs)
+    ran = pipeline_utils.run_pipeline(stages,
+                                      memo_dir,
+                                      targets=targets or None,
+                                      max_workers=max_workers,
+                                      force=force)
+    logger.info("ran %d stages: %s", len(ran), ', '.join(ran))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=settings.DEFAULT_LOG_FMT)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    dotenv.load_dotenv(dotenv.find_dotenv())
+
+    main()
@@ -0,0 +1,84 @@
+import numpy as np
+import xarray as xr
+
+# dims along which scenario datasets are chunked one slice at a time
+SCENARIO_DIMS = ['change_num', 'scenario_run', 'param_set']
+
+# quantization of temperatures (in °C) as 16-bit integers
+T_QUANTIZE_ENCODING = dict(dtype='int16',
+                           scale_factor=np.float32(0.01),
+                           add_offset=np.float32(0),
+                           _FillValue=np.iinfo('int16').min)
+
+# attribute listing the change_nums whose slices are repeated across runs
+REPEATED_ATTR = 'repeated_change_nums'
+
+
+def get_encoding(scenario_ds,
+                 compression='zlib',
+                 complevel=4,
+                 quantize_t=False):
+    # netCDF encoding with one (compressed) chunk per scenario
+    encoding = {}
+    for var, var_da in scenario_ds.data_vars.items():
+        var_encoding = dict(chunksizes=tuple(
+            1 if dim in SCENARIO_DIMS else size
+            for dim, size in zip(var_da.dims, var_da.shape)))
+        if compression == 'zlib':
+            var_encoding.update(zlib=True, complevel=complevel, shuffle=True)
+        elif compression is not None:
+            # e.g., 'zstd', requires netCDF4 (and netcdf-c) with the filter
+            var_encoding.update(compression=compression,
+                                complevel=complevel,
+                                shuffle=True)
+        if var == 'T' and quantize_t:
+            var_encoding.update(T_QUANTIZE_ENCODING)
+        encoding[var] = var_encoding
+
+    return encoding
+
+
+def dedup_scenario_runs(scenario_ds, var='T'):
+    # keep only the first scenario run of the change_nums whose slices are
+    # identical for all runs (e.g., the baseline), and fill the others with
+    # nodata so that they take (almost) no space once compressed. The
+    # repeated change_nums are listed in an attribute so that the dataset can
+    # be restored with `open_scenario_ds`
+    var_da = scenario_ds[var]
+    if 'scenario_run' not in var_da.dims:
+        return scenario_ds
+    first_da = var_da.isel(scenario_run=0)
+    repeated_ser = ((var_da == first_da) |
+                    (var_da.isnull() & first_da.isnull())).all(
+                        dim=[dim for dim in var_da.dims
+                             if dim != 'change_num']).to_series()
+    repeated_change_nums = repeated_ser.index[repeated_ser].tolist()
+    if not repeated_change_nums:
+        return scenario_ds
+
+    dedup_da = var_da.where(
+        ~var_da['change_num'].isin(repeated_change_nums)
+        | (var_da['scenario_run'] == var_da['scenario_run'][0]))
+    dedup_da.attrs = dict(var_da.attrs,
+                          **{REPEATED_ATTR: repeated_change_nums})
+    return scenario_ds.assign({var: dedup_da})
+
+
+def open_scenario_ds(filepath, **open_dataset_kws):
+    # open a scenario dataset, restoring the slices removed by
+    # `dedup_scenario_runs`
+    scenario_ds = xr.open_dataset(filepath, **open_dataset_kws)
+    for var, var_da in scenario_ds.data_vars.items():
+        if REPEATED_ATTR not in var_da.attrs:
+            continue
+        repeated_change_nums = np.atleast_1d(var_da.attrs[REPEATED_ATTR])
+        restored_da = var_da.where(
+            ~var_da['change_num'].isin(repeated_change_nums),
+            var_da.isel(scenario_run=0))
+        restored_da.attrs = {
+            key: value
+            for key, value in var_da.attrs.items() if key != REPEATED_ATTR
+        }
+        scenario_ds[var] = restored_da
+
+    return scenario_ds
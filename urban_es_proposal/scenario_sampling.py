@@ -0,0 +1,111 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# default number of change_nums of the initial (coarse) grid
+ADAPTIVE_INIT_NUM = 5
+
+
+def get_grid_change_nums(change_num_min, change_num_max, change_num_step,
+                         num):
+    # `num` (roughly) evenly-spaced change_nums, snapped to multiples of
+    # `change_num_step` from `change_num_min`
+    num_steps = (change_num_max - change_num_min) // change_num_step
+    return change_num_min + change_num_step * np.unique(
+        np.round(np.linspace(0, num_steps, num)).astype(int))
+
+
+def get_response_df(scenario_t_da):
+    # mean temperature of each scenario (and over the parameter sets, if
+    # any), with the change_nums as index and the scenario runs (if any) as
+    # columns
+    response_da = scenario_t_da.mean(dim=[
+        dim for dim in scenario_t_da.dims
+        if dim not in ['change_num', 'scenario_run']
+    ])
+    if 'scenario_run' in response_da.dims:
+        return response_da.transpose('change_num', 'scenario_run').to_pandas()
+    return response_da.to_series().to_frame()
+
+
+def get_interval_scores(response_df):
+    # score each interval between consecutive sampled change_nums by how
+    # poorly it is known from its end points, i.e., the maximum of:
+    # * the bend of the (mean) response curve, measured at each interior
+    #   point as its deviation from the line through its neighbours
+    # * the standard error of the mean response across scenario runs
+    change_nums = response_df.index.values
+    mean_arr = response_df.mean(axis=1).values
+    num_runs = response_df.shape[1]
+    sem_arr = response_df.std(axis=1, ddof=0).values / np.sqrt(num_runs)
+
+    bend_arr = np.zeros_like(mean_arr)
+    if len(change_nums) > 2:
+        x0, x1, x2 = change_nums[:-2], change_nums[1:-1], change_nums[2:]
+        y0, y1, y2 = mean_arr[:-2], mean_arr[1:-1], mean_arr[2:]
+        bend_arr[1:-1] = np.abs(y1 - (y0 + (y2 - y0) * (x1 - x0) / (x2 - x0)))
+    point_score_arr = np.maximum(bend_arr, sem_arr)
+
+    return pd.Series(np.maximum(point_score_arr[:-1], point_score_arr[1:]),
+                     index=pd.MultiIndex.from_arrays(
+                         [change_nums[:-1], change_nums[1:]],
+                         names=['start', 'end']))
+
+
+def get_refine_change_nums(interval_scores, change_num_step, tol, max_num):
+    # grid midpoints of the intervals whose score exceeds `tol`, worst first,
+    # up to `max_num` of them. Intervals that are a single step wide cannot be
+    # refined further
+    refine_change_nums = []
+    for (start, end), score in interval_scores.sort_values(
+            ascending=False).items():
+        if score <= tol or len(refine_change_nums) >= max_num:
+            break
+        mid_change_num = start + (end - start) // (2 * change_num_step) * \
+            change_num_step
+        if mid_change_num > start:
+            refine_change_nums.append(mid_change_num)
+
+    return np.sort(refine_change_nums).astype(int)
+
+
+def sample_scenario_t_da(simulate_t_da,
+                         change_num_min,
+                         change_num_max,
+                         change_num_step,
+                         num_runs=1,
+                         tol=0.01,
+                         max_ucm_runs=None,
+                         init_num=ADAPTIVE_INIT_NUM):
+    # adaptively sample the change_nums (on the grid of `change_num_step`):
+    # start from `init_num` evenly-spaced change_nums and iteratively simulate
+    # the midpoints of the intervals where the response curve bends or the
+    # scenario runs disagree by more than `tol` (in °C), until no interval
+    # exceeds the tolerance, the grid cannot be refined further, or
+    # `max_ucm_runs` (i.e., number of change_nums times `num_runs`) is spent.
+    # `simulate_t_da` takes an array of change_nums and returns the
+    # corresponding (computed) temperature data array
+    logger = logging.getLogger(__name__)
+    max_num = np.inf if max_ucm_runs is None else max_ucm_runs // num_runs
+
+    change_nums = get_grid_change_nums(change_num_min, change_num_max,
+                                       change_num_step,
+                                       min(init_num, max_num))
+    scenario_t_da = simulate_t_da(change_nums)
+    while len(change_nums) > 0:
+        interval_scores = get_interval_scores(get_response_df(scenario_t_da))
+        change_nums = get_refine_change_nums(
+            interval_scores, change_num_step, tol,
+            max_num - scenario_t_da.sizes['change_num'])
+        logger.info(
+            "sampled %d change_nums (max. interval score %.4f), refining %d",
+            scenario_t_da.sizes['change_num'], interval_scores.max(),
+            len(change_nums))
+        if len(change_nums) > 0:
+            scenario_t_da = xr.concat(
+                [scenario_t_da, simulate_t_da(change_nums)],
+                dim='change_num').sortby('change_num')
+
+    return scenario_t_da
@@ -0,0 +1,79 @@
+import json
+import os
+import uuid
+from os import path
+
+import numpy as np
+import xarray as xr
+import zarr
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+class ScenarioStore:
+    # chunked (zarr) store of a scenario dataset where each (change_num,
+    # scenario_run) slice is written as soon as it is completed. The store
+    # keeps a manifest of the completed slices so that an interrupted run can
+    # be resumed
+    def __init__(self, store_filepath, template_ds, resume=False):
+        self.store_filepath = store_filepath
+        self.manifest_filepath = path.join(store_filepath, MANIFEST_FILENAME)
+        # dims of the slices, i.e., `change_num` and (if any) `scenario_run`,
+        # where each slice holds all the parameter sets (if any) of a scenario
+        self.scenario_dims = [
+            dim for dim in template_ds['T'].dims[:-2] if dim != 'param_set'
+        ]
+        self.param_sets = template_ds['T'].attrs.get('param_sets')
+        self.scenario_coords = {
+            dim: template_ds[dim].values.tolist()
+            for dim in self.scenario_dims
+        }
+        self.variables = list(template_ds.data_vars)
+
+        if resume and path.exists(self.manifest_filepath):
+            with open(self.manifest_filepath) as src:
+                manifest = json.load(src)
+            if manifest['scenario_coords'] != self.scenario_coords:
+                raise ValueError(
+                    f"Cannot resume {store_filepath} since its scenarios "
+                    f"{manifest['scenario_coords']} do not match the "
+                    f"requested ones {self.scenario_coords}")
+            if manifest.get('param_sets') != self.param_sets:
+                raise ValueError(
+                    f"Cannot resume {store_filepath} since its parameter sets "
+                    "do not match the requested ones")
+            self.completed = set(map(tuple, manifest['completed']))
+        else:
+            # write the metadata, coordinates and non-dask (i.e., static)
+            # variables
+            template_ds.to_zarr(store_filepath, mode='w', compute=False)
+            self.completed = set()
+            self._dump_manifest()
+
+    def _dump_manifest(self):
+        # write to a temporary file and rename so that the manifest is atomic
+        tmp_filepath = f'{self.manifest_filepath}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filepath, 'w') as dst:
+            json.dump(
+                dict(scenario_coords=self.scenario_coords,
+                     param_sets=self.param_sets,
+                     completed=sorted(self.completed)), dst)
+        os.replace(tmp_filepath, self.manifest_filepath)
+
+    def get_pending(self):
+        # positional indices of the slices that are not in the store yet
+        shape = [len(self.scenario_coords[dim]) for dim in self.scenario_dims]
+        return [
+            index for index in np.ndindex(*shape)
+            if index not in self.completed
+        ]
+
+    def write(self, index, arr_dict):
+        group = zarr.open_group(self.store_filepath, mode='r+')
+        for var, arr in arr_dict.items():
+            group[var][index] = arr
+        self.completed.add(tuple(int(i) for i in index))
+        self._dump_manifest()
+
+    def open_dataset(self):
+        return xr.open_zarr(self.store_filepath)
@@ -0,0 +1,190 @@
+import json
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio import vrt, warp
+from scipy import ndimage
+
+# UCM parameters used by the surrogate (with InVEST's defaults), which can be
+# overridden with the calibrated ones
+SURROGATE_UCM_PARAMS = dict(t_air_average_radius=500,
+                            green_area_cooling_distance=100,
+                            cc_weight_shade=0.6,
+                            cc_weight_albedo=0.2,
+                            cc_weight_eti=0.2)
+# biophysical table columns used by the surrogate
+BIOPHYSICAL_COLUMNS = ['shade', 'albedo', 'kc', 'green_area']
+
+
+def read_aligned_arr(raster_filepath, rio_meta, resampling='bilinear'):
+    # read a raster resampled to the grid of `rio_meta`
+    with rio.open(raster_filepath) as src:
+        with vrt.WarpedVRT(src,
+                           crs=rio_meta['crs'],
+                           transform=rio_meta['transform'],
+                           width=rio_meta['width'],
+                           height=rio_meta['height'],
+                           resampling=warp.Resampling[resampling]) as vrt_src:
+            arr = vrt_src.read(1, masked=True)
+    return arr.astype('float64').filled(np.nan)
+
+
+def _smooth(arr, sigma):
+    # gaussian kernel convolution that ignores (and fills) nan values
+    valid_arr = ~np.isnan(arr)
+    weight_arr = ndimage.gaussian_filter(valid_arr.astype('float64'), sigma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ndimage.gaussian_filter(np.where(valid_arr, arr, 0),
+                                       sigma) / weight_arr
+
+
+# fast emulator of the UCM air temperature as a linear combination of the
+# cooling capacity and green area rasters (derived from the biophysical
+# table) convolved with gaussian kernels at the UCM's two spatial scales, i.e.,
+# the green area cooling distance and the air temperature averaging radius.
+# Its coefficients are fitted to already simulated (LULC, T) pairs
+class UCMSurrogate:
+    def __init__(self,
+                 biophysical_df,
+                 res,
+                 eti_arr=None,
+                 ucm_params=None,
+                 coef_arr=None):
+        self.biophysical_df = biophysical_df[BIOPHYSICAL_COLUMNS]
+        self.res = res
+        # evapotranspiration index without the crop coefficient, i.e., the
+        # normalized reference evapotranspiration
+        self.eti_arr = eti_arr
+        self.ucm_params = SURROGATE_UCM_PARAMS.copy()
+        if ucm_params is not None:
+            self.ucm_params.update({
+                key: value
+                for key, value in ucm_params.items()
+                if key in SURROGATE_UCM_PARAMS
+            })
+        self.coef_arr = coef_arr
+
+        # dense look-up table from LULC codes to biophysical values (nan for
+        # unknown codes, e.g., nodata)
+        lucodes = self.biophysical_df.index.values.astype(int)
+        self._lut_arr = np.full((lucodes.max() + 2, len(BIOPHYSICAL_COLUMNS)),
+                                np.nan)
+        self._lut_arr[lucodes] = self.biophysical_df.values
+
+    @classmethod
+    def from_biophysical_table(cls,
+                               biophysical_table_filepath,
+                               rio_meta,
+                               ref_et_raster_filepath=None,
+                               ucm_params=None):
+        biophysical_df = pd.read_csv(biophysical_table_filepath)
+        biophysical_df.columns = biophysical_df.columns.str.lower()
+        if ref_et_raster_filepath is not None:
+            ref_et_arr = read_aligned_arr(ref_et_raster_filepath, rio_meta)
+            eti_arr = ref_et_arr / np.nanmax(ref_et_arr)
+        else:
+            eti_arr = None
+
+        return cls(biophysical_df.set_index('lucode'),
+                   rio_meta['transform'].a,
+                   eti_arr=eti_arr,
+                   ucm_params=ucm_params)
+
+    def get_feature_arrs(self, lulc_arr):
+        lulc_arr = np.asarray(lulc_arr).astype(int)
+        # codes outside the table are mapped to its last (nan) row
+        lulc_arr = np.where((lulc_arr >= 0) & (lulc_arr < len(self._lut_arr)),
+                            lulc_arr, -1)
+        shade_arr, albedo_arr, kc_arr, green_arr = np.moveaxis(
+            self._lut_arr[lulc_arr], -1, 0)
+        eti_arr = kc_arr if self.eti_arr is None else kc_arr * self.eti_arr
+        cc_arr = self.ucm_params['cc_weight_shade'] * shade_arr + \
+            self.ucm_params['cc_weight_albedo'] * albedo_arr + \
+            self.ucm_params['cc_weight_eti'] * eti_arr
+
+        feature_arrs = [np.ones_like(cc_arr), cc_arr]
+        for param in ['green_area_cooling_distance', 't_air_average_radius']:
+            sigma = self.ucm_params[param] / self.res
+            feature_arrs += [_smooth(cc_arr, sigma), _smooth(green_arr, sigma)]
+
+        return np.stack(feature_arrs)
+
+    def fit(self, lulc_arrs, t_arrs, max_pixels=None, random_state=None):
+        # least squares fit of the coefficients, optionally on a random
+        # sample of (up to) `max_pixels` valid pixels split evenly among the
+        # scenarios. The pixels of each scenario are sampled as soon as its
+        # features are computed so that only those of the sample are kept
+        rng = np.random.default_rng(random_state)
+        X_arrs, y_arrs = [], []
+        for i, (lulc_arr, t_arr) in enumerate(zip(lulc_arrs, t_arrs)):
+            feature_arrs = self.get_feature_arrs(lulc_arr).reshape(
+                -1, np.size(lulc_arr))
+            y_arr = np.asarray(t_arr).ravel()
+            pixels = np.flatnonzero(~np.isnan(y_arr)
+                                    & ~np.isnan(feature_arrs).any(axis=0))
+            if max_pixels is not None:
+                num_pixels = max_pixels // len(lulc_arrs) + (
+                    i < max_pixels % len(lulc_arrs))
+                if len(pixels) > num_pixels:
+                    pixels = rng.choice(pixels, num_pixels, replace=False)
+            X_arrs.append(feature_arrs[:, pixels].T)
+            y_arrs.append(y_arr[pixels])
+        self.coef_arr = np.linalg.lstsq(np.concatenate(X_arrs),
+                                        np.concatenate(y_arrs),
+                                        rcond=None)[0]
+
+        return self
+
+    def predict_t_arr(self, lulc_arr):
+        return np.tensordot(self.coef_arr, self.get_feature_arrs(lulc_arr),
+                            axes=1)
+
+    def predict_t_arrs(self, lulc_arrs):
+        return np.stack(
+            [self.predict_t_arr(lulc_arr) for lulc_arr in lulc_arrs])
+
+    def score(self, lulc_arrs, t_arrs):
+        # error metrics of the surrogate against (held-out) UCM runs, both
+        # pixel-wise and for the scenarios' mean temperature, which is what
+        # matters to rank (i.e., screen) scenarios
+        t_arrs = np.asarray(t_arrs)
+        pred_arrs = self.predict_t_arrs(lulc_arrs)
+        valid_cond = ~np.isnan(t_arrs) & ~np.isnan(pred_arrs)
+        err_arr = (pred_arrs - t_arrs)[valid_cond]
+        t_ser = pd.Series(
+            np.nanmean(np.where(valid_cond, t_arrs, np.nan), axis=(1, 2)))
+        pred_ser = pd.Series(
+            np.nanmean(np.where(valid_cond, pred_arrs, np.nan), axis=(1, 2)))
+
+        return dict(
+            rmse=float(np.sqrt(np.mean(err_arr**2))),
+            mae=float(np.mean(np.abs(err_arr))),
+            r2=float(1 - np.sum(err_arr**2) / np.sum(
+                (t_arrs[valid_cond] - t_arrs[valid_cond].mean())**2)),
+            mean_t_rmse=float(np.sqrt(np.mean((pred_ser - t_ser)**2))),
+            # spearman correlation, i.e., pearson correlation of the ranks
+            mean_t_spearman=float(pred_ser.rank().corr(t_ser.rank())),
+            num_scenarios=len(t_arrs))
+
+    def dump(self, dst_filepath):
+        np.savez(dst_filepath,
+                 lucodes=self.biophysical_df.index.values,
+                 biophysical_arr=self.biophysical_df.values,
+                 res=self.res,
+                 eti_arr=np.array([]) if self.eti_arr is None else
+                 self.eti_arr,
+                 ucm_params=json.dumps(self.ucm_params),
+                 coef_arr=self.coef_arr)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath) as src:
+            eti_arr = src['eti_arr']
+            return cls(pd.DataFrame(src['biophysical_arr'],
+                                    index=src['lucodes'],
+                                    columns=BIOPHYSICAL_COLUMNS),
+                       float(src['res']),
+                       eti_arr=eti_arr if eti_arr.size else None,
+                       ucm_params=json.loads(str(src['ucm_params'])),
+                       coef_arr=src['coef_arr'])
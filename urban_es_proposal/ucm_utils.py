@@ -0,0 +1,350 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from os import path
+
+import invest_ucm_calibration as iuc
+import numpy as np
+
+from urban_es_proposal import raster_utils
+
+# persistent UCM workers of the current process, keyed by thread and settings,
+# since concurrent tasks (e.g., of a threaded dask scheduler) would otherwise
+# overwrite each other's LULC raster and workspace
+_UCM_WORKERS = {}
+
+# chunk size to hash files
+HASH_BLOCK_SIZE = 2**20
+
+
+def _ucm_worker_key(rio_meta, biophysical_table_filepath,
+                    ref_et_raster_filepath, t_ref, uhi_max, ucm_params,
+                    cc_method):
+    # `t_ref` and `uhi_max` are usually pandas series (one value per date)
+    return json.dumps([
+        {key: str(value)
+         for key, value in rio_meta.items()}, biophysical_table_filepath,
+        ref_et_raster_filepath,
+        np.atleast_1d(t_ref).tolist(),
+        np.atleast_1d(uhi_max).tolist(), ucm_params, cc_method
+    ],
+                      sort_keys=True)
+
+
+# keep a warm UCM wrapper so that repeated simulations on the same grid do not
+# pay for the dummy UCM run with which `iuc.UCMWrapper` gets the output raster
+# metadata: the wrapper is built once from the first LULC array, and afterwards
+# each new LULC array just overwrites the worker's LULC raster. Note that every
+# prediction still runs the whole InVEST model, i.e., including the alignment
+# of the LULC and ref. ET rasters and the reading of the biophysical table. The
+# LULC raster must be an actual file since InVEST's taskgraph relies on its
+# size and modification time to tell whether it has to be aligned again
+class UCMWorker:
+    def __init__(self,
+                 rio_meta,
+                 biophysical_table_filepath,
+                 ref_et_raster_filepath,
+                 t_ref,
+                 uhi_max,
+                 ucm_params,
+                 cc_method='factors'):
+        self.rio_meta = rio_meta
+        self.biophysical_table_filepath = biophysical_table_filepath
+        self.ref_et_raster_filepath = ref_et_raster_filepath
+        self.t_ref = t_ref
+        self.uhi_max = uhi_max
+        self.ucm_params = ucm_params
+        self.cc_method = cc_method
+
+        self.workspace_dir = tempfile.mkdtemp()
+        self.lulc_raster_filepath = path.join(self.workspace_dir, 'lulc.tif')
+        self.ucm_wrapper = None
+
+    def write_lulc_raster(self, lulc_arr):
+        # write the LULC array to the worker's raster and return its path.
+        # Workers of other UCM parameters (with the same grid) can read the
+        # same raster, yet each of them still runs the whole UCM from it
+        with raster_utils.open_raster(self.lulc_raster_filepath,
+                                      profile='temp',
+                                      **self.rio_meta) as dst:
+            dst.write(np.asarray(lulc_arr), 1)
+        return self.lulc_raster_filepath
+
+    def predict_t_arr(self, lulc_arr, lulc_raster_filepath=None):
+        if lulc_raster_filepath is None:
+            lulc_raster_filepath = self.write_lulc_raster(lulc_arr)
+        if self.ucm_wrapper is None:
+            self.ucm_wrapper = iuc.UCMWrapper(
+                lulc_raster_filepath,
+                self.biophysical_table_filepath,
+                self.cc_method,
+                self.ref_et_raster_filepath,
+                self.t_ref,
+                self.uhi_max,
+                extra_ucm_args=self.ucm_params,
+                workspace_dir=self.workspace_dir)
+        # the grid does not change across scenarios, so the UCM can read the
+        # LULC directly from the (overwritten) raster rather than from a copy
+        # aligned at initialization
+        self.ucm_wrapper.base_args['lulc_raster_path'] = lulc_raster_filepath
+        return self.ucm_wrapper.predict_t_arr(0)
+
+    def close(self):
+        shutil.rmtree(self.workspace_dir, ignore_errors=True)
+
+
+def get_ucm_worker(rio_meta,
+                   biophysical_table_filepath,
+                   ref_et_raster_filepath,
+                   t_ref,
+                   uhi_max,
+                   ucm_params,
+                   cc_method='factors'):
+    # get the persistent worker of this thread, or create it on first use
+    key = (threading.get_ident(),
+           _ucm_worker_key(rio_meta, biophysical_table_filepath,
+                           ref_et_raster_filepath, t_ref, uhi_max,
+                           ucm_params, cc_method))
+    try:
+        return _UCM_WORKERS[key]
+    except KeyError:
+        ucm_worker = UCMWorker(
+            rio_meta,
+            biophysical_table_filepath,
+            ref_et_raster_filepath,
+            t_ref,
+            uhi_max,
+            ucm_params,
+            cc_method=cc_method)
+        _UCM_WORKERS[key] = ucm_worker
+        return ucm_worker
+
+
+def predict_t_arr(lulc_arr, **ucm_worker_kws):
+    # module-level function so that the UCM worker arguments can be curried
+    # (and pickled to other processes) with `functools.partial`
+    return get_ucm_worker(**ucm_worker_kws).predict_t_arr(lulc_arr)
+
+
+def predict_t_arrs(lulc_arr, param_sets, **ucm_worker_kws):
+    # simulate a LULC array for each parameter set, i.e., a dict of `t_ref`,
+    # `uhi_max`, `ucm_params` and `cc_method`. Only the LULC raster is shared,
+    # i.e., written once, whereas each parameter set is a full UCM run
+    ucm_workers = [
+        get_ucm_worker(**ucm_worker_kws, **param_set)
+        for param_set in param_sets
+    ]
+    lulc_raster_filepath = ucm_workers[0].write_lulc_raster(lulc_arr)
+    return np.stack([
+        ucm_worker.predict_t_arr(lulc_arr,
+                                 lulc_raster_filepath=lulc_raster_filepath)
+        for ucm_worker in ucm_workers
+    ])
+
+
+@atexit.register
+def close_ucm_workers():
+    for ucm_worker in _UCM_WORKERS.values():
+        ucm_worker.close()
+    _UCM_WORKERS.clear()
+
+
+# content-addressed cache of simulated temperature arrays
+def _file_digest(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as src:
+        for block in iter(lambda: src.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_lulc_digest(lulc_arr, token=''):
+    lulc_arr = np.ascontiguousarray(lulc_arr)
+    h = hashlib.sha256(token.encode())
+    h.update(str((lulc_arr.shape, lulc_arr.dtype.str)).encode())
+    h.update(lulc_arr.data)
+    return h.hexdigest()
+
+
+def get_ucm_token(rio_meta,
+                  biophysical_table_filepath,
+                  ref_et_raster_filepath,
+                  t_ref,
+                  uhi_max,
+                  ucm_params,
+                  cc_method):
+    # digest of everything but the LULC array that determines the simulated
+    # temperatures, i.e., grid, input files (by content) and UCM parameters
+    return hashlib.sha256(
+        json.dumps([
+            str(rio_meta['crs']),
+            tuple(rio_meta['transform']), rio_meta['width'],
+            rio_meta['height'],
+            _file_digest(biophysical_table_filepath),
+            _file_digest(ref_et_raster_filepath),
+            np.atleast_1d(t_ref).tolist(),
+            np.atleast_1d(uhi_max).tolist(), ucm_params, cc_method
+        ],
+                   sort_keys=True).encode()).hexdigest()
+
+
+def get_ensemble_token(rio_meta,
+                       biophysical_table_filepath,
+                       ref_et_raster_filepath,
+                       param_sets):
+    # token of the simulations of a LULC array for several parameter sets
+    return hashlib.sha256(
+        json.dumps([
+            get_ucm_token(rio_meta, biophysical_table_filepath,
+                          ref_et_raster_filepath, **param_set)
+            for param_set in param_sets
+        ]).encode()).hexdigest()
+
+
+# counters of the temperature caches created by this process, which are also
+# dumped by the copies of the caches in worker processes (under the `stats`
+# directory of the cache) so that they can be aggregated here
+STATS_SESSION = uuid.uuid4().hex
+STATS_KEYS = ['hits', 'misses', 'evictions']
+
+
+def _get_stats_dir(cache_dir):
+    return path.join(cache_dir, 'stats')
+
+
+def get_t_cache_stats(cache_dir, session=STATS_SESSION, clear=False):
+    # hits, misses and evictions of the caches of `session` in `cache_dir`
+    # across (worker) processes, removing their records if `clear` is True
+    stats = dict.fromkeys(STATS_KEYS, 0)
+    stats_dir = _get_stats_dir(cache_dir)
+    if not path.exists(stats_dir):
+        return stats
+    for entry in os.scandir(stats_dir):
+        if not (entry.name.startswith(session)
+                and entry.name.endswith('.json')):
+            continue
+        try:
+            with open(entry.path) as src:
+                entry_stats = json.load(src)
+        except (OSError, ValueError):
+            continue
+        for key in STATS_KEYS:
+            stats[key] += entry_stats.get(key, 0)
+        if clear:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return stats
+
+
+class TCache:
+    def __init__(self, cache_dir, ucm_token, max_size=None):
+        self.cache_dir = cache_dir
+        self.ucm_token = ucm_token
+        # maximum size of the cache (in bytes), `None` means unbounded
+        self.max_size = max_size
+        self.session = STATS_SESSION
+        os.makedirs(_get_stats_dir(cache_dir), exist_ok=True)
+        self._reset_stats()
+
+    def __setstate__(self, state):
+        # copies sent to worker processes count their own hits, misses and
+        # evictions
+        self.__dict__.update(state)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_filepath = path.join(
+            _get_stats_dir(self.cache_dir),
+            f'{self.session}-{uuid.uuid4().hex}.json')
+
+    def _dump_stats(self):
+        # write to a temporary file and rename so that records are atomic
+        tmp_filepath = f'{self._stats_filepath}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filepath, 'w') as dst:
+            json.dump(self.local_stats, dst)
+        os.replace(tmp_filepath, self._stats_filepath)
+
+    def get_key(self, lulc_arr):
+        return get_lulc_digest(lulc_arr, token=self.ucm_token)
+
+    def _get_filepath(self, key):
+        return path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key):
+        filepath = self._get_filepath(key)
+        try:
+            t_arr = np.load(filepath)
+        except (FileNotFoundError, ValueError):
+            # missing or partially written entry
+            self.misses += 1
+            self._dump_stats()
+            return None
+        # touch the entry so that it is the last to be evicted (LRU), unless
+        # another process evicted it in the meantime
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        self._dump_stats()
+        return t_arr
+
+    def set(self, key, t_arr):
+        filepath = self._get_filepath(key)
+        # write to a temporary file and rename so that entries are atomic
+        tmp_filepath = f'{filepath}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_filepath, 'wb') as dst:
+            np.save(dst, t_arr)
+        os.replace(tmp_filepath, filepath)
+        self.evict()
+
+    def _get_entries(self):
+        # (mtime, size, path) of the entries, skipping those removed by other
+        # processes (sharing the cache) while listing them
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield entry_stat.st_mtime, entry_stat.st_size, entry.path
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = sorted(self._get_entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, filepath in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                # evicted by another process
+                pass
+            else:
+                self.evictions += 1
+            size -= entry_size
+        self._dump_stats()
+
+    @property
+    def local_stats(self):
+        # counters of this copy of the cache only
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+    @property
+    def stats(self):
+        return get_t_cache_stats(self.cache_dir, session=self.session)